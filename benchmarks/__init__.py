@@ -0,0 +1,2 @@
+# エンドポイントの負荷ベンチマーク
+#   python -m benchmarks.run --help
@@ -0,0 +1,209 @@
+# エンドポイントの負荷ベンチマーク
+# SQLiteにデータを投入し、FastAPIのappをプロセス内で並列に呼び出して
+# スループット・レイテンシ（p50/p95/p99）・SQL実行回数をエンドポイントごとに計測する
+#
+#   python -m benchmarks.run --scale small --requests 500 --concurrency 20 --out bench.json
+#
+# 結果のJSONはコミット間で比較できるように、キーの順番を固定して出力する
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+# 各エンドポイントのリクエストを作る関数（乱数は呼び出し側で固定する）
+def _stocks(rng, data):
+    return "POST", "/Stocks/", {"params": {"date": rng.choice(data["days"]), "category": rng.choice(data["categories"])}}
+
+def _reservation(rng, data):
+    return "GET", "/Reservation/", {"params": {"user_id": str(rng.randint(1, data["users"])), "date": rng.choice(data["days"])}}
+
+def _my_coupon(rng, data):
+    return "GET", "/MyCoupon/", {"params": {"user_id": rng.randint(1, data["users"])}}
+
+def _transaction(rng, data):
+    return "POST", "/TransactionData/", {"params": {"user_id": str(rng.randint(1, data["users"])), "prd_code": rng.choice(data["product_codes"])}}
+
+def _token(rng, data):
+    from benchmarks.seed import BENCH_PASSWORD, user_name
+    return "POST", "/token", {"data": {"username": user_name(rng.randint(1, data["users"])), "password": BENCH_PASSWORD}}
+
+SCENARIOS = {
+    "stocks": _stocks,
+    "reservation": _reservation,
+    "my_coupon": _my_coupon,
+    "transaction": _transaction,
+    "token": _token,
+}
+
+
+# 最近傍順位法でパーセンタイルを求める
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+# SQLの実行回数を数える
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+# 1つのエンドポイントに対して、concurrency本のクライアントからrequests回リクエストを送る
+async def run_scenario(client, name, make_request, data, requests, concurrency, counter, random_seed):
+    rng = random.Random(f"{random_seed}-{name}")
+    planned = [make_request(rng, data) for _ in range(requests)]
+    latencies = []
+    errors = {}
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(planned):
+            method, url, kwargs = planned[next_index]
+            next_index += 1
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[response.status_code] = errors.get(response.status_code, 0) + 1
+
+    statements_before = counter.count
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    statements = counter.count - statements_before
+
+    latencies.sort()
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "requests": requests,
+        "errors": dict(sorted(errors.items())),
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(requests / elapsed, 2) if elapsed else None,
+        "mean_ms": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p95_ms": to_ms(percentile(latencies, 95)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+        "sql_statements": statements,
+        "sql_per_request": round(statements / requests, 3) if requests else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args):
+    import httpx
+    from sqlalchemy import event
+
+    import main
+    from benchmarks.seed import SCALES, seed
+
+    size = SCALES[args.scale]
+    seed_start = time.perf_counter()
+    data = seed(main.engine, size, args.seed)
+    seed_elapsed = time.perf_counter() - seed_start
+
+    counter = StatementCounter()
+    event.listen(main.engine, "before_cursor_execute", counter)
+    event.listen(main.async_engine.sync_engine, "before_cursor_execute", counter)
+
+    results = {}
+    # lifespanイベント（起動時の索引作成など）を実行してから計測する
+    await main.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for name in args.endpoints:
+                if args.warmup:
+                    await run_scenario(client, name, SCENARIOS[name], data, args.warmup, args.concurrency, counter, f"{args.seed}-warmup")
+                results[name] = await run_scenario(client, name, SCENARIOS[name], data, args.requests, args.concurrency, counter, args.seed)
+                print(format_row(name, results[name]), file=sys.stderr)
+    finally:
+        await main.app.router.shutdown()
+        event.remove(main.engine, "before_cursor_execute", counter)
+        event.remove(main.async_engine.sync_engine, "before_cursor_execute", counter)
+
+    return {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database_url": os.environ["DATABASE_URL"],
+            "scale": args.scale,
+            "seed_size": size.to_dict(),
+            "random_seed": args.seed,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "seed_elapsed_s": round(seed_elapsed, 3),
+        },
+        "results": results,
+    }
+
+
+def format_row(name, result):
+    return (
+        f"{name:<12} {result['throughput_rps']:>9} req/s  "
+        f"p50 {result['p50_ms']:>8} ms  p95 {result['p95_ms']:>8} ms  p99 {result['p99_ms']:>8} ms  "
+        f"sql/req {result['sql_per_request']:>6}  errors {result['errors']}"
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the POS API endpoints in-process against seeded SQLite data.")
+    parser.add_argument("--scale", choices=["small", "medium", "large"], default="small")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="warm-up requests per endpoint (not measured)")
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent clients")
+    parser.add_argument("--endpoints", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=42, help="random seed for data and requests")
+    parser.add_argument("--db", help="SQLite file to use (default: a temporary file)")
+    parser.add_argument("--bcrypt-rounds", type=int, help="override BCRYPT_ROUNDS for the /token benchmark")
+    parser.add_argument("--out", help="write the JSON result to this file (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    # mainをimportする前に接続先などの環境変数を決める
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="pos-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    if args.bcrypt_rounds is not None:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+
+    report = asyncio.run(run_benchmark(args))
+    output = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,170 @@
+# ベンチマーク用のデータ投入
+# 乱数のシードを固定しているので、同じサイズ指定なら毎回同じデータになる
+import random
+from dataclasses import dataclass, asdict
+from datetime import date, timedelta
+
+from sqlalchemy import Table, Column, Integer, insert
+
+import main
+
+
+# 投入するデータの件数
+@dataclass
+class SeedSize:
+    stores: int = 3
+    days: int = 7
+    categories: int = 5
+    products: int = 200
+    users: int = 200
+    coupons: int = 20
+    reservations_per_user: int = 20
+    coupons_per_user: int = 10
+    transactions: int = 5000
+    pieces: int = 1000
+
+    def to_dict(self):
+        return asdict(self)
+
+# 規模ごとの既定値
+SCALES = {
+    "small": SeedSize(stores=1, days=3, categories=3, products=50, users=50, reservations_per_user=5, coupons_per_user=3, transactions=500),
+    "medium": SeedSize(),
+    "large": SeedSize(stores=5, days=30, categories=10, products=2000, users=2000, reservations_per_user=50, coupons_per_user=20, transactions=100000),
+}
+
+BENCH_PASSWORD = "benchmark"
+
+
+def product_code(product_id: int) -> str:
+    return f"49{product_id:011d}"
+
+def category_name(category_id: int) -> str:
+    return f"category{category_id}"
+
+def user_name(user_id: int) -> str:
+    return f"user{user_id}"
+
+
+def create_tables(engine):
+    # productsのALLERGY_IDが参照するallergiesはモデルにないので、ベンチマーク用に最低限の定義を足す
+    if "allergies" not in main.Base.metadata.tables:
+        Table("allergies", main.Base.metadata, Column("ID", Integer, primary_key=True))
+    main.Base.metadata.drop_all(engine)
+    main.Base.metadata.create_all(engine)
+
+# データを投入し、ベンチマークで使う値（日付・カテゴリー名など）を返す
+def seed(engine, size: SeedSize, random_seed: int = 42):
+    rng = random.Random(random_seed)
+    today = date.today()
+    days = [today + timedelta(days=i) for i in range(size.days)]
+    # パスワードハッシュは全ユーザー共通（bcryptを人数分計算しない）
+    password_hash = main.hash_password(BENCH_PASSWORD)
+
+    create_tables(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(main.Date), [
+            {"ID": i + 1, "DATE": day, "WEEK": day.strftime("%a")} for i, day in enumerate(days)
+        ])
+        conn.execute(insert(main.Category), [
+            {"ID": i, "NAME": category_name(i)} for i in range(1, size.categories + 1)
+        ])
+        products = [
+            {
+                "ID": i,
+                "PRD_CODE": product_code(i),
+                "PRD_NAME": f"product{i}",
+                "PRD_IMAGE": f"https://example.com/images/{i}.png",
+                "DESCRIPTION": "benchmark product " * 10,
+                "PRICE": rng.randrange(100, 1000, 10),
+                "CAL": round(rng.uniform(100, 900), 1),
+                "SALINITY": round(rng.uniform(0.5, 5.0), 1),
+                "ALLERGY_ID": None,
+                "CATEGORY_ID": rng.randint(1, size.categories),
+            }
+            for i in range(1, size.products + 1)
+        ]
+        conn.execute(insert(main.Product), products)
+        stocks = []
+        for date_id in range(1, size.days + 1):
+            for store_id in range(1, size.stores + 1):
+                for product_id in range(1, size.products + 1):
+                    stocks.append({
+                        "ID": len(stocks) + 1,
+                        "PRD_ID": str(product_id),
+                        "STORE_ID": store_id,
+                        "DATE_ID": date_id,
+                        "LOT": days[date_id - 1],
+                        "BEST_BY_DAY": days[date_id - 1] + timedelta(days=1),
+                        "PIECES": size.pieces,
+                    })
+        conn.execute(insert(main.ProductStocks), stocks)
+        conn.execute(insert(main.User), [
+            {
+                "ID": i,
+                "USER_NAME": user_name(i),
+                "EMAIL": f"{user_name(i)}@example.com",
+                "PASSWORD": password_hash,
+                "IS_ACTIVE": True,
+                "employee_Id": i,
+            }
+            for i in range(1, size.users + 1)
+        ])
+        conn.execute(insert(main.Coupon), [
+            {"ID": i, "NAME": f"coupon{i}", "IMAGE": None, "DESCRIPTION": "benchmark coupon", "EXPIRATION": 30, "PRICE": rng.randrange(10, 200, 10)}
+            for i in range(1, size.coupons + 1)
+        ])
+        my_coupons = []
+        for user_id in range(1, size.users + 1):
+            for _ in range(size.coupons_per_user):
+                get_date = today - timedelta(days=rng.randint(0, 60))
+                my_coupons.append({
+                    "ID": len(my_coupons) + 1,
+                    "USER_ID": user_id,
+                    "COUPON_ID": rng.randint(1, size.coupons),
+                    "GET_DATE": get_date,
+                    "EXP_DATE": get_date + timedelta(days=30),
+                    "STATUS": rng.choice((1, 1, 1, 2)),
+                })
+        if my_coupons:
+            conn.execute(insert(main.MyCoupon), my_coupons)
+        reservations = []
+        stocks_per_day = size.stores * size.products
+        for user_id in range(1, size.users + 1):
+            for _ in range(size.reservations_per_user):
+                day_index = rng.randrange(size.days)
+                if my_coupons and rng.random() < 0.1:
+                    # 1割はクーポンの予約（STOCK_IDが9999）
+                    stock_id, my_coupon_id = 9999, str(rng.randint(1, len(my_coupons)))
+                else:
+                    stock_id, my_coupon_id = day_index * stocks_per_day + rng.randint(1, stocks_per_day), "0"
+                reservations.append({
+                    "RSV_TIME": days[day_index],
+                    "STOCK_ID": stock_id,
+                    "USER_ID": str(user_id),
+                    "MY_COUPON_ID": my_coupon_id,
+                    "MET": 0,
+                    "DATE": days[day_index].isoformat(),
+                })
+        if reservations:
+            conn.execute(insert(main.Reservation), reservations)
+        transactions = [
+            {
+                "USER_ID": rng.randint(1, size.users),
+                "PRD_ID": rng.randint(1, size.products),
+                "MY_COUPON_ID": None,
+                "DATE": today - timedelta(days=rng.randint(0, 90)),
+            }
+            for _ in range(size.transactions)
+        ]
+        for transaction in transactions:
+            transaction["AMOUNT"] = products[transaction["PRD_ID"] - 1]["PRICE"]
+        if transactions:
+            conn.execute(insert(main.TransactionData), transactions)
+
+    return {
+        "days": [day.isoformat() for day in days],
+        "categories": [category_name(i) for i in range(1, size.categories + 1)],
+        "product_codes": [product_code(i) for i in range(1, size.products + 1)],
+        "users": size.users,
+    }
@@ -1,20 +1,75 @@
-from fastapi import FastAPI, HTTPException, Body, Depends, status
+from fastapi import FastAPI, HTTPException, Body, Depends, Query, Request, status
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from datetime import datetime, date, timedelta, timezone
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-from sqlalchemy import create_engine, Column, Integer, String, Date, Float, ForeignKey, Boolean, func
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy import create_engine, event, select, insert, update, delete, case, cast, and_, or_, text, Column, Integer, String, Date, Float, ForeignKey, Boolean, DateTime, Index, PrimaryKeyConstraint, func
+from sqlalchemy import Date as SQLDate
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool, StaticPool
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
-from typing import Optional
+from typing import List, Optional
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging 
 #import config 
 from passlib.context import CryptContext
 from fastapi.params import Depends
 from jose import jwt, JWTError
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
 from fastapi.security import OAuth2PasswordRequestForm,OAuth2PasswordBearer
 import os
+import ssl
+import operator
+import multiprocessing
+import hashlib
+import asyncio
+import json
+import time
+import threading
+import base64
+import bisect
+import contextvars
+import random
+
+# 起動時・終了時の処理（呼び出す関数やオブジェクトは後で定義する）
+@asynccontextmanager
+async def lifespan(app):
+    await check_mysql_insert_ids()
+    await build_barcode_index()
+    await warm_stock_snapshots()
+    coupon_sweeper.start()
+    if TRANSACTION_WRITE_BEHIND:
+        transaction_batcher.start()
+    try:
+        yield
+    finally:
+        # キューに残った取引を書き込んでから、配信・バックグラウンド処理を止める
+        await transaction_batcher.stop()
+        await coupon_sweeper.stop()
+        await stock_hub.close()
+        password_hasher.shutdown()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 通信許可するドメインリスト
 origins = [
@@ -32,29 +87,474 @@ FRONT_SERVER = os.getenv('FRONT_SERVER')
 if FRONT_SERVER:
     origins.append(FRONT_SERVER)
 
-# CORSを回避するために追加
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,   # ブラウザからリクエスト受けた時の認証情報サーバー送信可否指定。Trueの場合は許可
-    allow_methods=["*"],      # 許可するHTTPメソッドリスト(Get,Post,Putなど) ["*"]と指定することですべてのHTTPメソッドを許可
-    allow_headers=["*"]       # 許可するHTTPヘッダーリスト  ["*"]と指定することですべてのHTTPヘッダーを許可
-)
+# 大きな一覧のレスポンスを圧縮する（brotli_asgiがあればbr、なければgzip）
+COMPRESSION_MINIMUM_SIZE = int(os.getenv('COMPRESSION_MINIMUM_SIZE', '1024'))
+# SSEは圧縮すると少しずつ送れなくなるので対象外にする
+UNCOMPRESSED_PATHS = ("/Stocks/stream",)
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int):
+        self.app = app
+        if BrotliMiddleware is not None:
+            self.compressed_app = BrotliMiddleware(app, minimum_size=minimum_size, gzip_fallback=True)
+        else:
+            self.compressed_app = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] not in UNCOMPRESSED_PATHS:
+            await self.compressed_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
 
 # ロガーのインスタンスを作成する
 logger = logging.getLogger(__name__)
 
 
-# 認証情報 パスワードのハッシュ化
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 認証情報 パスワードのハッシュ化（bcryptのコストは環境変数で変更可能）
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 def hash_password(password: str):
     return "hashed_" + password
 #認証情報 SSL
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 
-# データベースへの接続を取得
-def get_db_connection():
+# DB接続プールの設定（環境変数で上書き可能）
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# 全SQLのログ出力（デバッグ用。通常は下のスロークエリログを使う）
+DB_ECHO = os.getenv('DB_ECHO', 'false').lower() == 'true'
+# スロークエリログ（SLOW_QUERY_MS以上かかったSQLを、SLOW_QUERY_SAMPLE_RATEの割合でログに出す）
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_SAMPLE_RATE = float(os.getenv('SLOW_QUERY_SAMPLE_RATE', '1.0'))
+
+# ヒストグラムの区切り（秒・回数）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Prometheusのラベル表記を作る
+def _format_labels(names, values):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+# ラベルごとに累積するヒストグラム
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # ラベル → [区切りごとの件数, 合計, 件数]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            prefix = _format_labels(self.label_names, labels)
+            prefix = prefix + "," if prefix else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            labels_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{{{labels_text}}} {total}")
+            lines.append(f"{self.name}_count{{{labels_text}}} {count}")
+        return lines
+
+# ラベルごとに加算するカウンター
+class MetricCounter:
+    def __init__(self, name: str, help_text: str, label_names: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{{{_format_labels(self.label_names, labels)}}} {value}")
+        return lines
+
+# アプリ全体の計測値
+request_latency = Histogram("pos_http_request_duration_seconds", "HTTP request latency by route.", ("method", "route"))
+request_db_time = Histogram("pos_http_request_db_seconds", "Time spent executing SQL per HTTP request.", ("method", "route"))
+request_statements = Histogram("pos_http_request_sql_statements", "SQL statements executed per HTTP request.", ("method", "route"), STATEMENT_BUCKETS)
+requests_total = MetricCounter("pos_http_requests_total", "HTTP requests by route and status code.", ("method", "route", "status"))
+pool_checkout_wait = Histogram("pos_db_pool_checkout_wait_seconds", "Time spent waiting for a pooled DB connection.", ("pool",), POOL_WAIT_BUCKETS)
+pool_checkout_timeouts = MetricCounter("pos_db_pool_checkout_timeouts_total", "Pool checkouts that timed out.", ("pool",))
+slow_queries_total = MetricCounter("pos_db_slow_queries_total", "SQL statements slower than SLOW_QUERY_MS.", ("route",))
+
+# 接続待ち時間を計測する接続プール
+class InstrumentedQueuePool(QueuePool):
+    metrics_label = "sync"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_checkout_timeouts.inc((self.metrics_label,))
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            pool_checkout_wait.observe((self.metrics_label,), waited)
+            stats = _request_stats.get()
+            if stats is not None:
+                stats.pool_wait += waited
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    metrics_label = "async"
+
+# リクエスト中のDB時間・接続待ち時間・SQL実行回数（ミドルウェアがリクエストごとに用意する）
+class RequestStats:
+    __slots__ = ("scope", "db_time", "pool_wait", "statements")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.statements = 0
+
+    @property
+    def route(self):
+        route = self.scope.get("route")
+        return route.path if route is not None else "unmatched"
+
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+# SQLの実行時間を計測し、リクエストの集計とスロークエリログに反映する
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.db_time += elapsed
+        stats.statements += 1
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        route = stats.route if stats is not None else "-"
+        slow_queries_total.inc((route,))
+        if random.random() < SLOW_QUERY_SAMPLE_RATE:
+            # パラメータには個人情報が入るのでSQL文だけを出す
+            logger.warning(f"Slow query {elapsed * 1000:.1f} ms on {route}: {' '.join(statement.split())[:2000]}")
+
+def _discard_query_start(exception_context):
+    starts = exception_context.connection.info.get("query_start") if exception_context.connection is not None else None
+    if starts:
+        starts.pop()
+
+def instrument_engine(target_engine):
+    event.listen(target_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(target_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(target_engine, "handle_error", _discard_query_start)
+
+# ルートごとのレイテンシ・DB時間・SQL実行回数を記録するASGIミドルウェア
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope)
+        token = _request_stats.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_stats.reset(token)
+            labels = (scope["method"], stats.route)
+            request_latency.observe(labels, elapsed)
+            request_db_time.observe(labels, stats.db_time)
+            request_statements.observe(labels, stats.statements)
+            requests_total.inc((*labels, status_code))
+
+# 同時実行数の制御（アドミッションコントロール）の設定
+# 上限はDBの遅延を見て増減する（遅延が目標以下なら少しずつ増やし、超えたら割合で減らす）
+# 遅延はリクエストごとの「接続待ち時間＋SQL1件あたりの実行時間」で、一定時間ごとのp90を目標と比べる
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'true').lower() == 'true'
+ADMISSION_INITIAL_LIMIT = int(os.getenv('ADMISSION_INITIAL_LIMIT', str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+ADMISSION_MIN_LIMIT = int(os.getenv('ADMISSION_MIN_LIMIT', '4'))
+ADMISSION_MAX_LIMIT = int(os.getenv('ADMISSION_MAX_LIMIT', '100'))
+ADMISSION_TARGET_DB_MS = float(os.getenv('ADMISSION_TARGET_DB_MS', '50'))
+ADMISSION_BACKOFF = float(os.getenv('ADMISSION_BACKOFF', '0.9'))
+# p90を求める区間（秒）。上限を減らすのは区間ごとに最大1回
+ADMISSION_WINDOW = float(os.getenv('ADMISSION_WINDOW', '1.0'))
+# 区間内のDBを使ったリクエストがこれより少なければ判定しない（少数の遅いリクエストで下げないように）
+ADMISSION_MIN_SAMPLES = int(os.getenv('ADMISSION_MIN_SAMPLES', '20'))
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '1'))
+# クラスごとの使える上限の割合・待ち行列の長さ・最大待ち時間（秒）
+ADMISSION_CHECKOUT_QUEUE = int(os.getenv('ADMISSION_CHECKOUT_QUEUE', '200'))
+ADMISSION_CHECKOUT_WAIT = float(os.getenv('ADMISSION_CHECKOUT_WAIT', '5.0'))
+ADMISSION_RESERVATION_SHARE = float(os.getenv('ADMISSION_RESERVATION_SHARE', '0.8'))
+ADMISSION_RESERVATION_QUEUE = int(os.getenv('ADMISSION_RESERVATION_QUEUE', '100'))
+ADMISSION_RESERVATION_WAIT = float(os.getenv('ADMISSION_RESERVATION_WAIT', '2.0'))
+ADMISSION_BROWSING_SHARE = float(os.getenv('ADMISSION_BROWSING_SHARE', '0.6'))
+ADMISSION_BROWSING_QUEUE = int(os.getenv('ADMISSION_BROWSING_QUEUE', '100'))
+ADMISSION_BROWSING_WAIT = float(os.getenv('ADMISSION_BROWSING_WAIT', '0.5'))
+# 制御の対象外（計測・ドキュメント・ヘルスチェックと、接続しっぱなしのSSE）
+ADMISSION_EXEMPT_PATHS = ("/", "/metrics", "/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json", "/Stocks/stream")
+# 集計系の重いクエリは混雑と関係なく遅いので、上限の調整には使わない
+ADMISSION_SIGNAL_EXCLUDED_PATHS = ("/Analytics/",)
+
+# 優先度クラス（名前, 優先度, 使える上限の割合, 待ち行列の長さ, 最大待ち時間（秒））
+# 会計は上限いっぱいまで使えるが、閲覧は上限の一部しか使えないので、閲覧が混んでも会計の枠が残る
+ADMISSION_CLASSES = (
+    ("checkout", 0, 1.0, ADMISSION_CHECKOUT_QUEUE, ADMISSION_CHECKOUT_WAIT),
+    ("reservation", 1, ADMISSION_RESERVATION_SHARE, ADMISSION_RESERVATION_QUEUE, ADMISSION_RESERVATION_WAIT),
+    ("browsing", 2, ADMISSION_BROWSING_SHARE, ADMISSION_BROWSING_QUEUE, ADMISSION_BROWSING_WAIT),
+)
+
+# リクエストの優先度クラスを決める（ルーティング前なのでパスで判定する）
+def admission_class(method: str, path: str) -> str:
+    if method == "POST" and path.startswith("/TransactionData/"):
+        return "checkout"
+    if path.endswith("/history"):
+        return "browsing"
+    if path.startswith(("/Reservation/", "/CouponReservation/", "/MyCoupon/", "/token", "/users/")):
+        return "reservation"
+    return "browsing"
+
+class AdmissionClass:
+    __slots__ = ("name", "priority", "share", "max_queue", "max_wait", "waiters", "in_flight", "admitted", "rejected", "timeouts")
+
+    def __init__(self, name: str, priority: int, share: float, max_queue: int, max_wait: float):
+        self.name = name
+        self.priority = priority
+        self.share = share
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.waiters = deque()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+# 優先度つきの同時実行数の制限（ワーカープロセスごと）
+# 空きがなければクラスごとの待ち行列で待ち、枠が空いたら優先度の高いクラスから順に通す
+class AdmissionController:
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int, target_latency: float, classes):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self.latency_p90 = 0.0
+        # 直近の区間の判定（p90が目標を超えていればTrue。その間は上限を増やさない）
+        self.overloaded = False
+        self._samples = []
+        self._window_end = time.monotonic() + ADMISSION_WINDOW
+        self.classes = {name: AdmissionClass(name, *options) for name, *options in classes}
+        self._order = sorted(self.classes.values(), key=lambda item: item.priority)
+
+    def _capacity(self, admission: AdmissionClass) -> int:
+        return max(1, int(self.limit * admission.share))
+
+    def _admit(self, admission: AdmissionClass):
+        self.in_flight += 1
+        admission.in_flight += 1
+        admission.admitted += 1
+
+    # 枠を取れたらTrue、待ち行列があふれたか待ち時間を超えたらFalse
+    async def acquire(self, name: str) -> bool:
+        admission = self.classes[name]
+        # 同じか高い優先度のクラスに待ちがあれば追い越さない
+        waiting_ahead = any(item.waiters for item in self._order if item.priority <= admission.priority)
+        if not waiting_ahead and self.in_flight < self._capacity(admission):
+            self._admit(admission)
+            return True
+        if len(admission.waiters) >= admission.max_queue:
+            admission.rejected += 1
+            return False
+        future = asyncio.get_running_loop().create_future()
+        admission.waiters.append(future)
+        try:
+            await asyncio.wait_for(future, admission.max_wait)
+            return True
+        except asyncio.TimeoutError:
+            admission.timeouts += 1
+            return False
+        except asyncio.CancelledError:
+            # 枠を渡された直後に切断された場合は枠を返す
+            if future.done() and not future.cancelled():
+                self.release(name, None)
+            raise
+        finally:
+            try:
+                admission.waiters.remove(future)
+            except ValueError:
+                pass
+
+    # 枠を返し、DBの遅延で上限を調整してから待っているリクエストを通す
+    def release(self, name: str, latency: Optional[float]):
+        admission = self.classes[name]
+        self.in_flight -= 1
+        admission.in_flight -= 1
+        if latency is not None:
+            self._adjust(latency)
+        self._wake()
+
+    def _adjust(self, latency: float):
+        self._samples.append(latency)
+        now = time.monotonic()
+        if now >= self._window_end:
+            self._close_window(now)
+        elif not self.overloaded and self.in_flight + 1 >= int(self.limit) and self.limit < self.max_limit:
+            # 上限まで使っている時だけ増やす（1周期でおよそ1ずつ増える）
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.increases += 1
+
+    # 区間のp90で混雑を判定し、目標を超えていれば上限を割合で減らす
+    def _close_window(self, now: float):
+        samples = self._samples
+        self._samples = []
+        self._window_end = now + ADMISSION_WINDOW
+        if len(samples) < ADMISSION_MIN_SAMPLES:
+            self.overloaded = False
+            return
+        samples.sort()
+        self.latency_p90 = samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+        self.overloaded = self.latency_p90 > self.target_latency
+        if self.overloaded:
+            self.limit = max(self.min_limit, self.limit * ADMISSION_BACKOFF)
+            self.decreases += 1
+
+    def _wake(self):
+        for admission in self._order:
+            while admission.waiters and self.in_flight < self._capacity(admission):
+                future = admission.waiters.popleft()
+                if future.done():
+                    continue
+                self._admit(admission)
+                future.set_result(None)
+            # 高い優先度のクラスが待っている間は低いクラスを通さない
+            if admission.waiters:
+                break
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "latency_p90_ms": round(self.latency_p90 * 1000, 3),
+        }
+
+    def class_stats(self):
+        return {name: admission.stats() for name, admission in self.classes.items()}
+
+admission_controller = AdmissionController(
+    ADMISSION_INITIAL_LIMIT, ADMISSION_MIN_LIMIT, ADMISSION_MAX_LIMIT, ADMISSION_TARGET_DB_MS / 1000, ADMISSION_CLASSES,
+)
+
+# 混雑時はDBに届く前に503（Retry-After付き）を返すASGIミドルウェア
+# MetricsMiddlewareの内側に置き、断ったリクエストも計測に含め、リクエストごとのDB時間を上限の調整に使う
+# （SQLの件数が多いリクエストで遅く見えないよう1件あたりに直し、DBを使わなかったリクエストは数えない）
+class AdmissionControlMiddleware:
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in ADMISSION_EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        name = admission_class(scope["method"], scope["path"])
+        if not await self.controller.acquire(name):
+            response = JSONResponse(
+                {"detail": "Server is busy, please retry later"},
+                status_code=503,
+                headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+            return
+        stats = _request_stats.get()
+        latency = None
+        try:
+            await self.app(scope, receive, send)
+            if stats is not None and stats.statements and not scope["path"].startswith(ADMISSION_SIGNAL_EXCLUDED_PATHS):
+                latency = stats.pool_wait + stats.db_time / stats.statements
+        finally:
+            self.controller.release(name, latency)
+
+# ミドルウェアは後から追加したものが外側になる（計測 → CORS → アドミッションコントロール → 圧縮の順に通る）
+if ADMISSION_CONTROL:
+    app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
+
+# CORSを回避するために追加
+# アドミッションコントロールの外側に置き、混雑時の503にもCORSのヘッダーを付ける（ブラウザからRetry-Afterを読めるように）
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,   # ブラウザからリクエスト受けた時の認証情報サーバー送信可否指定。Trueの場合は許可
+    allow_methods=["*"],      # 許可するHTTPメソッドリスト(Get,Post,Putなど) ["*"]と指定することですべてのHTTPメソッドを許可
+    allow_headers=["*"],      # 許可するHTTPヘッダーリスト  ["*"]と指定することですべてのHTTPヘッダーを許可
+    expose_headers=["Retry-After"],  # 混雑時の503でフロントエンドから再試行までの秒数を読めるようにする
+)
+
+app.add_middleware(MetricsMiddleware)
+
+# 接続先URLを組み立てる（DATABASE_URLがあればそちらを優先）
+def get_database_url():
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    if DATABASE_URL:
+        return DATABASE_URL
+
     # MySQL設定(Azure)
     MYSQL_SERVER = os.getenv('MYSQL_SERVER')
     MYSQL_USER = os.getenv('MYSQL_USER')
@@ -70,22 +570,195 @@ def get_db_connection():
     # SSLの設定
     SSL_CONFIG = os.getenv('SSL_CONFIG')
 
-    # データベースに接続する
-    engine = create_engine(f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_SERVER}/{MYSQL_DB}?ssl_ca={SSL_CONFIG}", echo=True)
-
     # SQLiteの場合
     #DB_FILE = "pop-make-up_DB.db"
-    #engine =  create_engine(f"sqlite:///{DB_FILE}", echo=True)
+    #return f"sqlite:///{DB_FILE}"
+
+    return f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_SERVER}/{MYSQL_DB}?ssl_ca={SSL_CONFIG}"
+
+# プロセス全体で共有するエンジンを作成する
+def create_db_engine(url: str):
+    if url.startswith("sqlite"):
+        # SQLiteはスレッドをまたいで使うのでcheck_same_threadを外す
+        connect_args = {"check_same_thread": False}
+        if ":memory:" in url or url in ("sqlite://", "sqlite:///"):
+            # インメモリDBは全セッションで同じ接続を共有する
+            return create_engine(url, echo=DB_ECHO, connect_args=connect_args, poolclass=StaticPool)
+        return create_engine(url, echo=DB_ECHO, connect_args=connect_args, poolclass=InstrumentedQueuePool)
+    return create_engine(
+        url,
+        echo=DB_ECHO,
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+# データベースに接続する（起動時に1回だけ）
+engine = create_db_engine(get_database_url())
+
+# 非同期エンドポイント用の接続先URL（ASYNC_DATABASE_URLがあればそちらを優先）
+def get_async_database_url():
+    ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL')
+    if ASYNC_DATABASE_URL:
+        return make_url(ASYNC_DATABASE_URL)
+    url = make_url(get_database_url())
+    # 同期ドライバを非同期ドライバに置き換える
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    if url.get_backend_name() == "mysql":
+        return url.set(drivername="mysql+aiomysql")
+    return url
+
+# プロセス全体で共有する非同期エンジンを作成する
+def create_async_db_engine(url):
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            return create_async_engine(url, echo=DB_ECHO, poolclass=StaticPool)
+        return create_async_engine(url, echo=DB_ECHO)
+    connect_args = {}
+    # aiomysqlはssl_caを解釈しないのでSSLContextとして渡す
+    ssl_ca = url.query.get("ssl_ca")
+    if ssl_ca:
+        connect_args["ssl"] = ssl.create_default_context(cafile=ssl_ca)
+        url = url.difference_update_query(["ssl_ca"])
+    return create_async_engine(
+        url,
+        echo=DB_ECHO,
+        connect_args=connect_args,
+        poolclass=InstrumentedAsyncQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+async_engine = create_async_db_engine(get_async_database_url())
+
+# 同期・非同期どちらのエンジンのSQLも計測する
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+
+# AsyncSessionファクトリを作成する（コミット後も属性を読めるようにexpireしない）
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
 
-    # Sessionオブジェクトを作成する
-    session = sessionmaker(bind=engine)()
+# 非同期のデータベースセッションを取得（イベントループをブロックしない）
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
-    # 接続を返す
-    return session
+# MySQLの1文の複数行INSERTに連続したIDが振られるか（起動時に確認する。確認できるまでは1行ずつINSERTする）
+# innodb_autoinc_lock_modeが0か1なら連続する。MySQL 8の既定の2では同時に実行された他のINSERTとIDが交ざる
+mysql_consecutive_insert_ids = False
+
+async def check_mysql_insert_ids():
+    global mysql_consecutive_insert_ids
+    if async_engine.dialect.name != "mysql":
+        return
+    try:
+        async with async_engine.connect() as conn:
+            lock_mode, increment = (await conn.execute(
+                text("SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment")
+            )).one()
+    except Exception as e:
+        logger.warning(f"Could not read innodb_autoinc_lock_mode, inserting rows one by one: {e}", exc_info=True)
+        return
+    mysql_consecutive_insert_ids = int(lock_mode) in (0, 1) and int(increment) == 1
+    logger.info(
+        f"innodb_autoinc_lock_mode={lock_mode} auto_increment_increment={increment}: "
+        f"{'multi-row' if mysql_consecutive_insert_ids else 'row-by-row'} inserts"
+    )
+
+# 複数行をまとめて登録し、自動採番されたIDを登録した順に返す（コミットは呼び出し側で行う）
+async def bulk_insert_returning_ids(db: AsyncSession, model, rows: list) -> list:
+    if db.bind.dialect.insert_executemany_returning_sort_by_parameter_order:
+        # RETURNINGが使えるDBは1回のexecutemanyでIDまで取得する
+        result = await db.execute(insert(model).returning(model.ID, sort_by_parameter_order=True), rows)
+        return list(result.scalars())
+    if db.bind.dialect.name == "mysql" and mysql_consecutive_insert_ids:
+        # 連続したIDが振られる設定なら、最初のID（LAST_INSERT_ID）から並べる
+        result = await db.execute(insert(model).values(rows))
+        return list(range(result.lastrowid, result.lastrowid + len(rows)))
+    # それ以外のDBはORMで1行ずつINSERTしてIDを取得する
+    objs = [model(**row) for row in rows]
+    db.add_all(objs)
+    await db.flush()
+    return [obj.ID for obj in objs]
+
+# モデルインスタンスを辞書に変換する関数（カラム一覧はモデルごとに1回だけ作る）
+class RowSerializer:
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+        getter = operator.attrgetter(*self.columns)
+        # カラムが1つだとattrgetterはタプルを返さないので揃える
+        self._getter = getter if len(self.columns) > 1 else (lambda row: (getter(row),))
+
+    def __call__(self, row):
+        return dict(zip(self.columns, self._getter(row)))
+
+    def many(self, rows):
+        columns, getter = self.columns, self._getter
+        return [dict(zip(columns, getter(row))) for row in rows]
+
+_serializers = {}
+
+# モデルと除外するカラムの組み合わせごとにRowSerializerを作ってキャッシュする
+def get_serializer(model, exclude=()):
+    key = (model, frozenset(exclude))
+    serializer = _serializers.get(key)
+    if serializer is None:
+        serializer = RowSerializer(column.key for column in model.__table__.columns if column.key not in exclude)
+        _serializers[key] = serializer
+    return serializer
 
 # SQLAlchemyのモデルインスタンスを辞書に変換するヘルパー関数
 def to_dict(row):
-    return {column.name: getattr(row, column.name) for column in row.__table__.columns}
+    return get_serializer(type(row))(row)
+
+# 一覧表示で省略できる重いカラム
+LIST_VIEW_EXCLUDE = ("PRD_IMAGE", "IMAGE", "DESCRIPTION")
+
+# json.dumpsで日付型を文字列に変換するためのヘルパー関数
+def _json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# JSONのバイト列を作る（orjsonがあれば使う）
+def dumps_json(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# jsonable_encoderを通さずにそのままJSONにするレスポンス（一覧系のエンドポイントで使う）
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps_json(content)
+
+# レスポンス本文から弱いETagを作る（本文を作り直した時に1回だけ計算する）
+# CompressionMiddlewareがbr・gzipに圧縮すると同じETagでバイト列が変わるので、強いETagにはしない
+def make_etag(body: bytes) -> str:
+    return 'W/"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+# If-None-Matchのいずれかが弱い比較で一致するか（W/の有無は区別しない）
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+# ETag・Cache-Control付きでJSONを返す（一致すれば本文なしの304を返す）
+def conditional_json_response(request: Request, body: bytes, etag: str, cache_control: str):
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 
 class ProductStocks(BaseModel):
@@ -146,8 +819,14 @@ class TransactionRecord(BaseModel):
     USER_ID: int
     PRD_ID: int
     MY_COUPON_ID: int
+    AMOUNT: Optional[int]
     DATE: date
 
+class CheckoutBasket(BaseModel):
+    USER_ID: str
+    PRD_CODES: List[str]
+    MY_COUPON_ID: Optional[int] = None
+
 
 # データベースのテーブルを定義する
 Base = declarative_base()
@@ -155,99 +834,1053 @@ Base = declarative_base()
 # Userモデルの定義 社員番号を追加
 class User(Base):
     __tablename__ = "users"
+    # 社員番号はid_sequencesから払い出すので重複をDBでも防ぐ
+    __table_args__ = (Index("ux_users_employee_Id", "employee_Id", unique=True),)
 
-    ID = Column(Integer, primary_key=True, index=True)
+    ID = Column(Integer, primary_key=True)
     USER_NAME = Column(String(13), index=True)
     EMAIL = Column(String, unique=True, index=True)
     PASSWORD = Column(String)
     IS_ACTIVE = Column(Boolean, default=True)
-    employee_Id = Column(Integer,index=True)
+    employee_Id = Column(Integer)
 
 
 class Product(Base):
     __tablename__ = "products"
-    ID = Column(Integer, primary_key=True, index=True)
+    ID = Column(Integer, primary_key=True)
     PRD_CODE = Column(String(13), index=True)
-    PRD_NAME = Column(String(50), index=True)
-    PRD_IMAGE = Column(String, index=True, nullable=True)
-    DESCRIPTION = Column(String, index=True, nullable=True)
-    PRICE = Column(Integer, index=True)
-    CAL = Column(Float, index=True)
-    SALINITY = Column(Float, index=True)
+    PRD_NAME = Column(String(50))
+    PRD_IMAGE = Column(String, nullable=True)
+    DESCRIPTION = Column(String, nullable=True)
+    PRICE = Column(Integer)
+    CAL = Column(Float)
+    SALINITY = Column(Float)
     ALLERGY_ID = Column(Integer, ForeignKey('allergies.ID'), index=True, nullable=True)
     CATEGORY_ID = Column(Integer, index=True)
 
 # ProductStocksモデルの定義
 class ProductStocks(Base):
     __tablename__ = "stocks"
+    # 日付＋商品での在庫検索用の複合インデックス
+    __table_args__ = (Index("ix_stocks_DATE_ID_PRD_ID", "DATE_ID", "PRD_ID"),)
 
-    ID = Column(Integer, primary_key=True, index=True)
+    ID = Column(Integer, primary_key=True)
     PRD_ID = Column(String(13), ForeignKey('products.PRD_CODE'), index=True)
-    STORE_ID = Column(Integer, index=True)
-    DATE_ID = Column(Integer, index=True, nullable=True)
-    LOT = Column(Date, index=True)
-    BEST_BY_DAY = Column(Date, index=True)
-    PIECES = Column(Integer, index=True)
+    STORE_ID = Column(Integer)
+    DATE_ID = Column(Integer, nullable=True)
+    LOT = Column(Date)
+    BEST_BY_DAY = Column(Date)
+    PIECES = Column(Integer)
 
 # ReservationDataモデルの定義
 class Reservation(Base):
     __tablename__ = "reservations"
+    # ユーザー＋在庫での予約検索用と、予約履歴のページング用の複合インデックス
+    __table_args__ = (
+        Index("ix_reservations_USER_ID_STOCK_ID", "USER_ID", "STOCK_ID"),
+        Index("ix_reservations_USER_ID_DATE_ID", "USER_ID", "DATE", "ID"),
+    )
 
-    ID = Column(Integer, primary_key=True, index=True, autoincrement=True, unique=True)
-    RSV_TIME = Column(Date, index=True)
-    STOCK_ID = Column(Integer, index=True)
-    USER_ID = Column(String(13), ForeignKey('users.ID'), index=True)
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    RSV_TIME = Column(Date)
+    STOCK_ID = Column(Integer)
+    USER_ID = Column(String(13), ForeignKey('users.ID'))
     MY_COUPON_ID = Column(String(13), ForeignKey('coupons.ID'), index=True)
-    MET = Column(Integer, index=True)
-    DATE = Column(String, index=True)
+    MET = Column(Integer)
+    DATE = Column(String)
 
 # クーポンモデルの定義
 class Coupon(Base):
     __tablename__ = "coupons"
 
-    ID = Column(Integer, primary_key=True, index=True, autoincrement=True, unique=True)
-    NAME = Column(String(50), index=True)
-    IMAGE = Column(String, index=True, nullable=True)
-    DESCRIPTION = Column(String, index=True, nullable=True)
-    EXPIRATION = Column(Integer, index=True)
-    PRICE = Column(Integer, index=True)
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    NAME = Column(String(50))
+    IMAGE = Column(String, nullable=True)
+    DESCRIPTION = Column(String, nullable=True)
+    EXPIRATION = Column(Integer)
+    PRICE = Column(Integer)
 
 # マイクーポンの定義
 class MyCoupon(Base):
     __tablename__ = "my_coupons"
+    # ユーザーごとの有効なクーポン検索用の複合インデックス
+    # 期限切れの一括更新用に状態＋有効期限の複合インデックスも持つ
+    __table_args__ = (
+        Index("ix_my_coupons_USER_ID_STATUS_EXP_DATE", "USER_ID", "STATUS", "EXP_DATE"),
+        Index("ix_my_coupons_STATUS_EXP_DATE", "STATUS", "EXP_DATE"),
+    )
+
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    USER_ID = Column(Integer)
+    COUPON_ID = Column(Integer)
+    GET_DATE = Column(Date)
+    EXP_DATE = Column(Date)
+    STATUS = Column(Integer)
 
-    ID = Column(Integer, primary_key=True, index=True, autoincrement=True, unique=True)
-    USER_ID = Column(Integer, index=True)
-    COUPON_ID = Column(Integer, index=True)
-    GET_DATE = Column(Date, index=True)
-    EXP_DATE = Column(Date, index=True)
-    STATUS = Column(Integer, index=True)
+# マイクーポンのSTATUS（1: 未使用 2: 使用済み 3: 期限切れ）
+MY_COUPON_EXPIRED = 3
+
+# 期限切れから一定期間たったマイクーポンの保管先（my_couponsと同じカラム＋保管日時）
+class MyCouponArchive(Base):
+    __tablename__ = "my_coupons_archive"
+
+    ID = Column(Integer, primary_key=True, autoincrement=False)
+    USER_ID = Column(Integer)
+    COUPON_ID = Column(Integer)
+    GET_DATE = Column(Date)
+    EXP_DATE = Column(Date)
+    STATUS = Column(Integer)
+    ARCHIVED_AT = Column(DateTime)
 
 # 取引データの定義
 class TransactionData(Base):
     __tablename__ = "transaction_records"
-
-    ID = Column(Integer, primary_key=True, index=True, autoincrement=True, unique=True)
-    USER_ID = Column(Integer, index=True)
-    PRD_ID = Column(Integer, index=True)
-    MY_COUPON_ID = Column(Integer, index=True)
+    # 購入履歴のページング用の複合インデックス
+    __table_args__ = (Index("ix_transaction_records_USER_ID_DATE_ID", "USER_ID", "DATE", "ID"),)
+
+    ID = Column(Integer, primary_key=True, autoincrement=True)
+    USER_ID = Column(Integer)
+    PRD_ID = Column(Integer)
+    MY_COUPON_ID = Column(Integer)
+    # 販売時の金額（商品の価格が変わっても売上集計を同じ金額で作り直せるように記録する）
+    AMOUNT = Column(Integer)
     DATE = Column(Date, index=True)
 
 # 日にちの定義
 class Date(Base):
     __tablename__ = "dates"
 
-    ID = Column(Integer, primary_key=True, index=True, autoincrement=True, unique=True)
+    ID = Column(Integer, primary_key=True, autoincrement=True)
     DATE = Column(Date, index=True)
-    WEEK = Column(String, index=True)
+    WEEK = Column(String)
 
 # カテゴリーの定義
 class Category(Base):
     __tablename__ = "categories"
 
-    ID = Column(Integer, primary_key=True, index=True, autoincrement=True, unique=True)
+    ID = Column(Integer, primary_key=True, autoincrement=True)
     NAME = Column(String, index=True)
 
+# 採番テーブル（NAMEごとに次に払い出す番号を持つ）
+class IdSequence(Base):
+    __tablename__ = "id_sequences"
+
+    NAME = Column(String(64), primary_key=True)
+    NEXT_VALUE = Column(Integer, nullable=False)
+
+# 売上の集計（日付・商品・クーポンごとの販売数と売上。クーポンなしはCOUPON_ID=0）
+class SalesRollup(Base):
+    __tablename__ = "sales_rollups"
+    __table_args__ = (PrimaryKeyConstraint("DATE", "PRD_ID", "COUPON_ID"),)
+
+    DATE = Column(SQLDate, nullable=False)
+    PRD_ID = Column(Integer, nullable=False)
+    COUPON_ID = Column(Integer, nullable=False, default=0)
+    CATEGORY_ID = Column(Integer)
+    UNITS = Column(Integer, nullable=False, default=0)
+    REVENUE = Column(Integer, nullable=False, default=0)
+
+# 在庫一覧で返すカラム（商品情報＋在庫情報。IDは在庫のIDになる）
+STOCK_PRODUCT_COLUMNS = (
+    Product.PRD_CODE,
+    Product.PRD_NAME,
+    Product.PRD_IMAGE,
+    Product.DESCRIPTION,
+    Product.PRICE,
+    Product.CAL,
+    Product.SALINITY,
+    Product.ALLERGY_ID,
+    Product.CATEGORY_ID,
+    ProductStocks.ID,
+    ProductStocks.PRD_ID,
+    ProductStocks.STORE_ID,
+    ProductStocks.DATE_ID,
+    ProductStocks.LOT,
+    ProductStocks.BEST_BY_DAY,
+    ProductStocks.PIECES,
+)
+
+# 一覧表示用に重いカラムを除いたカラム一覧を返す
+def project_columns(columns, exclude=LIST_VIEW_EXCLUDE):
+    return tuple(column for column in columns if column.key not in exclude)
+
+# 商品から在庫を引く結合条件（stocks.PRD_IDはVARCHARなので商品IDを文字列にして比べる）
+# 数値のまま比べるとMySQLはPRD_ID側を変換するので、ix_stocks_DATE_ID_PRD_IDのPRD_IDが使えなくなる
+STOCK_PRODUCT_JOIN = ProductStocks.PRD_ID == cast(Product.ID, String)
+
+# 日付・カテゴリーの解決から在庫と商品の結合までを1本のSQLで行うクエリ
+def build_stock_product_query(target_date, category, columns=STOCK_PRODUCT_COLUMNS):
+    return (
+        select(*columns)
+        .select_from(ProductStocks)
+        .join(Date, Date.ID == ProductStocks.DATE_ID)
+        .join(Product, STOCK_PRODUCT_JOIN)
+        .join(Category, Category.ID == Product.CATEGORY_ID)
+        .where(Date.DATE == target_date, Category.NAME == category)
+        .order_by(ProductStocks.ID)
+    )
+
+# 指定日の商品の在庫ID（同じ商品の在庫が複数ある場合は最初のもの）
+def build_product_stock_query(date_id, product_id):
+    return (
+        select(ProductStocks.ID)
+        .where(ProductStocks.DATE_ID == date_id, ProductStocks.PRD_ID == str(product_id))
+        .order_by(ProductStocks.ID)
+        .limit(1)
+    )
+
+# かごの商品コードに対応する商品と指定日の在庫
+def build_basket_stock_query(prd_codes, target_date):
+    return (
+        select(Product, ProductStocks.ID)
+        .select_from(ProductStocks)
+        .join(Date, Date.ID == ProductStocks.DATE_ID)
+        .join(Product, STOCK_PRODUCT_JOIN)
+        .where(Product.PRD_CODE.in_(set(prd_codes)), Date.DATE == target_date)
+        .order_by(ProductStocks.ID)
+    )
+
+# マイクーポン一覧で返すカラム（クーポン情報＋マイクーポン情報。IDはマイクーポンのIDになる）
+MY_COUPON_COLUMNS = (
+    Coupon.NAME,
+    Coupon.IMAGE,
+    Coupon.DESCRIPTION,
+    Coupon.EXPIRATION,
+    Coupon.PRICE,
+    MyCoupon.ID,
+    MyCoupon.USER_ID,
+    MyCoupon.COUPON_ID,
+    MyCoupon.GET_DATE,
+    MyCoupon.EXP_DATE,
+    MyCoupon.STATUS,
+)
+
+# ユーザーの有効期限内の未使用クーポンをクーポン情報と結合して取得するクエリ
+def build_my_coupon_query(user_id, today, columns=MY_COUPON_COLUMNS):
+    return (
+        select(*columns)
+        .select_from(MyCoupon)
+        .join(Coupon, Coupon.ID == MyCoupon.COUPON_ID)
+        .where(
+            MyCoupon.USER_ID == user_id,
+            MyCoupon.STATUS == 1,
+            MyCoupon.EXP_DATE >= today,
+        )
+        .order_by(MyCoupon.ID)
+    )
+
+# 参照データキャッシュの設定（環境変数で上書き可能）
+REFERENCE_CACHE_TTL = float(os.getenv('REFERENCE_CACHE_TTL', '300'))
+REFERENCE_CACHE_MAXSIZE = int(os.getenv('REFERENCE_CACHE_MAXSIZE', '4096'))
+
+# キャッシュに値がないことを表す目印
+_MISSING = object()
+
+# TTLとLRUで管理するインメモリキャッシュ（ヒット数・ミス数を記録する）
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                # 期限切れは削除してミス扱い
+                del self._data[key]
+                self.misses += 1
+                return default
+            # 最近使ったものを末尾へ移動
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            # 上限を超えたら一番古いものから削除
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# 日付・商品の読み込みキャッシュ
+# キーの先頭要素でどのモデルのデータかを区別する
+# （カテゴリー・クーポンは一覧のクエリで結合して取るので、ここではキャッシュしない）
+class ReferenceDataCache:
+    MODEL_KINDS = {
+        "Date": ("date",),
+        "Product": ("product", "product_code"),
+    }
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.cache = TTLCache(maxsize, ttl)
+
+    async def _get(self, db: AsyncSession, key, query):
+        value = self.cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = (await db.execute(query)).scalars().first()
+        if value is not None:
+            # リクエストをまたいで使うのでセッションから切り離して保存
+            db.expunge(value)
+            self.cache.set(key, value)
+        return value
+
+    async def get_date(self, db: AsyncSession, target_date):
+        if isinstance(target_date, str):
+            target_date = datetime.strptime(target_date, '%Y-%m-%d').date()
+        elif isinstance(target_date, datetime):
+            target_date = target_date.date()
+        return await self._get(db, ("date", target_date), select(Date).filter(Date.DATE == target_date))
+
+    async def get_product(self, db: AsyncSession, product_id):
+        product_id = int(product_id)
+        return await self._get(db, ("product", product_id), select(Product).filter(Product.ID == product_id))
+
+    async def get_product_by_code(self, db: AsyncSession, prd_code: str):
+        return await self._get(db, ("product_code", prd_code), select(Product).filter(Product.PRD_CODE == prd_code))
+
+    # モデル単位でキャッシュを破棄する（書き込み時のフック）
+    def invalidate_model(self, model_name: str):
+        kinds = self.MODEL_KINDS.get(model_name)
+        if kinds:
+            self.cache.invalidate_where(lambda key: key[0] in kinds)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+reference_cache = ReferenceDataCache(REFERENCE_CACHE_MAXSIZE, REFERENCE_CACHE_TTL)
+
+# テーブルごとの更新回数（コミット後に増やし、シリアライズ済みのレスポンスが古いかの判定に使う）
+table_versions = Counter()
+
+# 商品詳細のシリアライズ済みレスポンス（商品ID → (商品テーブルの版, ETag, 本文)）
+product_responses = TTLCache(REFERENCE_CACHE_MAXSIZE, REFERENCE_CACHE_TTL)
+
+# ブラウザ・プロキシでのキャッシュ時間（商品詳細はほぼ変わらない。在庫は毎回ETagで確認させる）
+PRODUCT_CACHE_MAX_AGE = int(os.getenv('PRODUCT_CACHE_MAX_AGE', '60'))
+
+# マイクーポン一覧のレスポンスキャッシュ（0秒なら無効）
+MY_COUPON_CACHE_TTL = float(os.getenv('MY_COUPON_CACHE_TTL', '0'))
+my_coupon_cache = TTLCache(int(os.getenv('MY_COUPON_CACHE_MAXSIZE', '10000')), MY_COUPON_CACHE_TTL)
+
+# 同じキーの読み込みが同時に来たら、DBへの問い合わせを1回にまとめて結果を共有する設定
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', '10'))
+
+# 同時に来た同じ読み込みを1回の処理にまとめる（single-flight）
+# 処理は最初の呼び出し側とは別のタスクで動かすので、誰かが切断・タイムアウトしても他の待ち手には結果が届く
+# 例外も待ち手全員に伝え、終わったらキーを外す（失敗した結果は残さず、次の呼び出しで再実行する）
+# 処理の中ではリクエストのセッションを使わず、自分でセッションを開くこと
+class SingleFlight:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.calls = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+        self._tasks = {}
+
+    async def do(self, key, fn, timeout: Optional[float] = None):
+        task = self._tasks.get(key)
+        if task is None:
+            self.calls += 1
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+        else:
+            self.coalesced += 1
+        try:
+            # shieldで包み、待ち手のキャンセル・タイムアウトが共有の処理に伝わらないようにする
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            self.timeouts += 1
+            raise HTTPException(status_code=503, detail="Timed out waiting for a shared read", headers={"Retry-After": "1"})
+
+    def _finish(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # 待ち手が全員いなくなっていても例外を回収しておく
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+
+    def stats(self):
+        return {
+            "in_flight": len(self._tasks),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+        }
+
+# 在庫一覧・商品詳細の読み込み
+stock_flights = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+product_flights = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+
+# マイクーポン一覧のキャッシュを破棄する（USER_IDは文字列で届くこともある）
+def invalidate_my_coupon_cache(user_id):
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return
+    # compact指定の有無で別々にキャッシュしているので両方消す
+    my_coupon_cache.invalidate((user_id, False))
+    my_coupon_cache.invalidate((user_id, True))
+
+# ORMでの書き込みを記録し、コミット後に該当モデルのキャッシュを破棄する
+def _record_reference_changes(session, flush_context):
+    touched = session.info.setdefault("reference_models", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        name = type(obj).__name__
+        if name in ReferenceDataCache.MODEL_KINDS:
+            touched.add(name)
+
+def _record_reference_bulk_changes(orm_execute_state):
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper is not None:
+        name = orm_execute_state.bind_mapper.class_.__name__
+        if name in ReferenceDataCache.MODEL_KINDS:
+            orm_execute_state.session.info.setdefault("reference_models", set()).add(name)
+
+def _invalidate_reference_cache(session):
+    for name in session.info.pop("reference_models", ()):
+        reference_cache.invalidate_model(name)
+        table_versions[name] += 1
+
+def _discard_reference_changes(session):
+    session.info.pop("reference_models", None)
+
+event.listen(Session, "after_flush", _record_reference_changes)
+event.listen(Session, "do_orm_execute", _record_reference_bulk_changes)
+event.listen(Session, "after_commit", _invalidate_reference_cache)
+event.listen(Session, "after_rollback", _discard_reference_changes)
+
+# 今日の日付行がまだない・作成に失敗した場合に、バーコード索引を作り直すまでの間隔（秒）
+BARCODE_INDEX_RETRY_INTERVAL = float(os.getenv('BARCODE_INDEX_RETRY_INTERVAL', '30'))
+
+# レジのバーコード読み取り用の索引（PRD_CODE → 商品ID・今日の在庫ID）
+# 起動時に作成し、商品や当日の在庫がORMで変更されたら差分だけ反映する
+class BarcodeIndex:
+    def __init__(self):
+        self.date = None
+        self.date_id = None
+        self.product_by_code = {}
+        self.code_by_product = {}
+        self.stocks_by_product = {}
+        self.build_time = 0.0
+        self.built_at = None
+        self.rebuild_count = 0
+        self.incremental_updates = 0
+        self.build_failures = 0
+        self.corrections = 0
+        # 今日の日付行がない・作成に失敗した時に、次に作り直してよい時刻
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+
+    # 指定日（省略時は今日）の索引を作り直す
+    async def build(self, target_date=None):
+        target_date = target_date or datetime.now().date()
+        async with self._lock:
+            await self._build(target_date)
+
+    async def _build(self, target_date):
+        start = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            products = (await db.execute(select(Product.ID, Product.PRD_CODE))).all()
+            date_id = (await db.execute(select(Date.ID).where(Date.DATE == target_date))).scalar()
+            stocks = []
+            if date_id is not None:
+                stocks = (await db.execute(
+                    select(ProductStocks.ID, ProductStocks.PRD_ID)
+                    .where(ProductStocks.DATE_ID == date_id)
+                    .order_by(ProductStocks.ID)
+                )).all()
+        product_by_code = {code: product_id for product_id, code in products}
+        code_by_product = {product_id: code for product_id, code in products}
+        stocks_by_product = {}
+        for stock_id, prd_id in stocks:
+            stocks_by_product.setdefault(int(prd_id), []).append(stock_id)
+        # 作り終えてから入れ替える（読み取り中のリクエストに途中の状態を見せない）
+        self.product_by_code = product_by_code
+        self.code_by_product = code_by_product
+        self.stocks_by_product = stocks_by_product
+        self.date = target_date
+        self.date_id = date_id
+        self.build_time = time.perf_counter() - start
+        self.built_at = datetime.now(timezone.utc)
+        self.rebuild_count += 1
+        # 今日の日付行がまだなければ、後で登録された時に拾えるよう一定時間ごとに作り直す
+        if date_id is None:
+            self._retry_at = time.monotonic() + BARCODE_INDEX_RETRY_INTERVAL
+
+    # 今日の索引として使えるか（日付行がない・作成に失敗した場合は、再試行の時刻までは作り直さない）
+    def _is_current(self, today) -> bool:
+        if self.date == today and self.date_id is not None:
+            return True
+        return time.monotonic() < self._retry_at
+
+    async def _refresh(self, today):
+        async with self._lock:
+            # ロック待ちの間に他のリクエストが作り直していれば何もしない
+            if self._is_current(today):
+                return
+            try:
+                await self._build(today)
+            except Exception as e:
+                # 作れなくても呼び出し側がDBから引くので、500にはせず少し待ってから作り直す
+                self.build_failures += 1
+                self._retry_at = time.monotonic() + BARCODE_INDEX_RETRY_INTERVAL
+                logger.warning(f"Barcode index rebuild failed: {e}", exc_info=True)
+
+    # PRD_CODEから (商品ID, 在庫ID) を返す。索引にない・今日の索引がない場合はNone（呼び出し側でDBから引く）
+    async def lookup(self, prd_code: str):
+        today = datetime.now().date()
+        if not self._is_current(today):
+            await self._refresh(today)
+        if self.date != today or self.date_id is None:
+            return None
+        product_id = self.product_by_code.get(prd_code)
+        if product_id is None:
+            return None
+        stock_ids = self.stocks_by_product.get(product_id)
+        if not stock_ids:
+            return None
+        return product_id, stock_ids[0]
+
+    # コミットされた商品・在庫の変更を索引に反映する
+    def apply_changes(self, products, deleted_products, stocks, deleted_stocks):
+        for product_id, code in products:
+            old_code = self.code_by_product.get(product_id)
+            if old_code is not None and old_code != code:
+                self.product_by_code.pop(old_code, None)
+            self.product_by_code[code] = product_id
+            self.code_by_product[product_id] = code
+        for product_id in deleted_products:
+            code = self.code_by_product.pop(product_id, None)
+            if code is not None:
+                self.product_by_code.pop(code, None)
+            self.stocks_by_product.pop(product_id, None)
+        for stock_id in deleted_stocks:
+            self._remove_stock(stock_id)
+        for stock_id, prd_id, date_id in stocks:
+            self._remove_stock(stock_id)
+            if date_id is not None and date_id == self.date_id and prd_id is not None:
+                stock_ids = self.stocks_by_product.setdefault(int(prd_id), [])
+                stock_ids.append(stock_id)
+                stock_ids.sort()
+        self.incremental_updates += 1
+
+    def _remove_stock(self, stock_id):
+        for stock_ids in self.stocks_by_product.values():
+            if stock_id in stock_ids:
+                stock_ids.remove(stock_id)
+
+    # 索引の在庫IDが古かった（在庫の作り直しや他のワーカーでの変更を取りこぼした）時に、DBで引き直した値に置き換える
+    def correct(self, product_id: int, stale_stock_id: int, stock_id: Optional[int]):
+        self._remove_stock(stale_stock_id)
+        if stock_id is not None and self.date_id is not None:
+            stock_ids = self.stocks_by_product.setdefault(product_id, [])
+            if stock_id not in stock_ids:
+                stock_ids.append(stock_id)
+                stock_ids.sort()
+        self.corrections += 1
+
+    def __len__(self):
+        return len(self.product_by_code)
+
+    def stats(self):
+        return {
+            "size": len(self.product_by_code),
+            "stocks": sum(len(stock_ids) for stock_ids in self.stocks_by_product.values()),
+            "date": self.date.isoformat() if self.date else None,
+            "build_time": self.build_time,
+            "built_at": self.built_at.isoformat() if self.built_at else None,
+            "rebuild_count": self.rebuild_count,
+            "incremental_updates": self.incremental_updates,
+            "build_failures": self.build_failures,
+            "corrections": self.corrections,
+        }
+
+barcode_index = BarcodeIndex()
+
+# 商品・在庫の変更をフラッシュ時に記録し、コミット後に索引へ反映する
+def _record_barcode_changes(session, flush_context):
+    changes = session.info.setdefault("barcode_changes", ([], [], [], []))
+    products, deleted_products, stocks, deleted_stocks = changes
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Product):
+            products.append((obj.ID, obj.PRD_CODE))
+        elif isinstance(obj, ProductStocks):
+            stocks.append((obj.ID, obj.PRD_ID, obj.DATE_ID))
+    for obj in session.deleted:
+        if isinstance(obj, Product):
+            deleted_products.append(obj.ID)
+        elif isinstance(obj, ProductStocks):
+            deleted_stocks.append(obj.ID)
+
+def _apply_barcode_changes(session):
+    changes = session.info.pop("barcode_changes", None)
+    if changes and any(changes):
+        barcode_index.apply_changes(*changes)
+
+def _discard_barcode_changes(session):
+    session.info.pop("barcode_changes", None)
+
+event.listen(Session, "after_flush", _record_barcode_changes)
+event.listen(Session, "after_commit", _apply_barcode_changes)
+event.listen(Session, "after_rollback", _discard_barcode_changes)
+
+# 起動時にバーコード索引を作成する
+async def build_barcode_index():
+    try:
+        await barcode_index.build()
+        logger.info(f"Barcode index built: {barcode_index.stats()}")
+    except Exception as e:
+        # 索引がなくてもDBから引けるので起動は止めない
+        logger.warning(f"Barcode index build failed: {e}", exc_info=True)
+
+# 在庫スナップショットの設定（0秒なら無効。他のワーカーでの更新はTTLで反映される）
+STOCK_SNAPSHOT_TTL = float(os.getenv('STOCK_SNAPSHOT_TTL', '30'))
+STOCK_SNAPSHOT_MAXSIZE = int(os.getenv('STOCK_SNAPSHOT_MAXSIZE', '256'))
+
+# 日付・カテゴリーごとの在庫一覧（行とシリアライズ済みのレスポンス本文）
+class StockSnapshot:
+    __slots__ = ("date_id", "rows", "positions", "body", "compact_body", "etag", "compact_etag", "expires_at")
+
+    def __init__(self, date_id, rows, ttl: float):
+        self.date_id = date_id
+        self.rows = rows
+        # 在庫ID → 行の位置
+        self.positions = {row["ID"]: i for i, row in enumerate(rows)}
+        self.expires_at = time.monotonic() + ttl
+        self.serialize()
+
+    def compact_rows(self):
+        return [{key: value for key, value in row.items() if key not in LIST_VIEW_EXCLUDE} for row in self.rows]
+
+    def serialize(self):
+        self.body = dumps_json({"status": "success", "data": self.rows})
+        self.compact_body = dumps_json({"status": "success", "data": self.compact_rows()})
+        self.etag = make_etag(self.body)
+        self.compact_etag = make_etag(self.compact_body)
+
+# 在庫一覧のスナップショット置き場
+# 初回アクセス時（起動時は今日・明日の分）に作り、会計で在庫が減ったらコミット後にその場で書き換える
+class StockSnapshotStore:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.updates = 0
+        self.evictions = 0
+        # (日付, カテゴリー名) → StockSnapshot
+        self._snapshots = OrderedDict()
+        # 在庫ID → スナップショットのキー
+        self._key_by_stock = {}
+        # 作成中に在庫が変わったかを判定するための世代番号
+        self._generation = 0
+        # COMMITを送ってからafter_commitでスナップショットに反映するまでの在庫の減算の数
+        self._pending_decrements = 0
+
+    async def get(self, target_date, category: str) -> StockSnapshot:
+        key = (target_date, category)
+        snapshot = self._get_fresh(key)
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+        self.misses += 1
+        # 同じキーの作成は同時に何件来ても1回にまとめる
+        return await stock_flights.do(key, lambda: self._build(key))
+
+    def _get_fresh(self, key):
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            return None
+        if snapshot.expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._snapshots.move_to_end(key)
+        return snapshot
+
+    async def _build(self, key):
+        target_date, category = key
+        generation = self._generation
+        # コミット中の減算があると、読み込んだ在庫に反映済みか分からない
+        settled = self._pending_decrements == 0
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(build_stock_product_query(target_date, category))
+            columns = tuple(result.keys())
+            rows = [dict(zip(columns, row)) for row in result]
+        date_id = rows[0]["DATE_ID"] if rows else None
+        snapshot = StockSnapshot(date_id, rows, self.ttl)
+        self.builds += 1
+        if generation != self._generation or not settled:
+            # 読み込み中に在庫が変わった（かもしれない）ので保存せず、このリクエストだけに使う
+            snapshot.expires_at = 0
+            return snapshot
+        self._remove(key)
+        self._snapshots[key] = snapshot
+        for stock_id in snapshot.positions:
+            self._key_by_stock[stock_id] = key
+        while len(self._snapshots) > self.maxsize:
+            self._remove(next(iter(self._snapshots)))
+            self.evictions += 1
+        return snapshot
+
+    def _remove(self, key):
+        snapshot = self._snapshots.pop(key, None)
+        if snapshot is not None:
+            for stock_id in snapshot.positions:
+                if self._key_by_stock.get(stock_id) == key:
+                    del self._key_by_stock[stock_id]
+
+    # 起動時に指定日の全カテゴリー分を作る
+    async def warm(self, dates):
+        async with AsyncSessionLocal() as db:
+            categories = (await db.execute(select(Category.NAME))).scalars().all()
+        for target_date in dates:
+            for category in categories:
+                await self.get(target_date, category)
+
+    # 在庫を減らしたセッションのCOMMIT前に呼ぶ
+    # 非同期ドライバーではCOMMITからafter_commitまでの間に他のタスクが動くので、
+    # その間に作られたスナップショットを保存しないようにする（保存すると同じ数を2回減らしてしまう）
+    def begin_decrements(self):
+        self._generation += 1
+        self._pending_decrements += 1
+
+    # COMMITが失敗した場合
+    def cancel_decrements(self):
+        self._pending_decrements -= 1
+
+    # コミットされた在庫の減算（在庫ID → 減らした数）をスナップショットに反映する
+    def apply_decrements(self, quantities: dict):
+        self._generation += 1
+        self._pending_decrements -= 1
+        touched = set()
+        for stock_id, quantity in quantities.items():
+            key = self._key_by_stock.get(stock_id)
+            snapshot = self._snapshots.get(key) if key is not None else None
+            if snapshot is None:
+                continue
+            snapshot.rows[snapshot.positions[stock_id]]["PIECES"] -= quantity
+            touched.add(key)
+        for key in touched:
+            snapshot = self._snapshots[key]
+            snapshot.serialize()
+            self.updates += 1
+
+    # 在庫の入荷・商品の変更など、差分で追えない変更があった日付のスナップショットを破棄する
+    def invalidate_dates(self, date_ids):
+        self._generation += 1
+        for key in [key for key, snapshot in self._snapshots.items() if snapshot.date_id in date_ids or snapshot.date_id is None]:
+            self._remove(key)
+
+    def clear(self):
+        self._generation += 1
+        self._snapshots.clear()
+        self._key_by_stock.clear()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def stats(self):
+        return {
+            "size": len(self._snapshots),
+            "maxsize": self.maxsize,
+            "stocks": len(self._key_by_stock),
+            "hits": self.hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "updates": self.updates,
+            "evictions": self.evictions,
+        }
+
+stock_snapshots = StockSnapshotStore(STOCK_SNAPSHOT_MAXSIZE, STOCK_SNAPSHOT_TTL)
+
+# 在庫・商品・日付・カテゴリーのORMでの変更をフラッシュ時に記録し、コミット後にスナップショットを破棄する
+# （会計による在庫の減算はdecrement_stocksが記録し、破棄せずにその場で書き換える）
+def _begin_stock_decrements(session):
+    if session.info.get("stock_decrements") and not session.info.get("stock_decrements_pending"):
+        session.info["stock_decrements_pending"] = True
+        stock_snapshots.begin_decrements()
+
+def _record_stock_snapshot_changes(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, ProductStocks):
+            session.info.setdefault("stock_snapshot_dates", set()).add(obj.DATE_ID)
+        elif isinstance(obj, (Product, Date, Category)):
+            session.info["stock_snapshot_clear"] = True
+
+def _apply_stock_snapshot_changes(session):
+    cleared = session.info.pop("stock_snapshot_clear", False)
+    if cleared:
+        stock_snapshots.clear()
+    date_ids = session.info.pop("stock_snapshot_dates", None)
+    if date_ids:
+        stock_snapshots.invalidate_dates(date_ids)
+    if cleared or date_ids:
+        stock_hub.request_resync()
+    quantities = session.info.pop("stock_decrements", None)
+    if session.info.pop("stock_decrements_pending", False):
+        stock_snapshots.apply_decrements(quantities or {})
+        if quantities:
+            stock_hub.publish_decrements(quantities)
+
+def _discard_stock_snapshot_changes(session):
+    for key in ("stock_snapshot_clear", "stock_snapshot_dates", "stock_decrements"):
+        session.info.pop(key, None)
+
+# COMMITが失敗した場合はafter_commitもafter_rollbackも呼ばれないことがあるので、トランザクションの終わりで片付ける
+def _end_stock_decrements(session, transaction):
+    if transaction.parent is None and session.info.pop("stock_decrements_pending", False):
+        session.info.pop("stock_decrements", None)
+        stock_snapshots.cancel_decrements()
+
+event.listen(Session, "before_commit", _begin_stock_decrements)
+event.listen(Session, "after_flush", _record_stock_snapshot_changes)
+event.listen(Session, "after_commit", _apply_stock_snapshot_changes)
+event.listen(Session, "after_rollback", _discard_stock_snapshot_changes)
+event.listen(Session, "after_transaction_end", _end_stock_decrements)
+
+# 起動時に今日・明日の在庫スナップショットを作成する
+async def warm_stock_snapshots():
+    if STOCK_SNAPSHOT_TTL <= 0:
+        return
+    try:
+        today = datetime.now().date()
+        await stock_snapshots.warm((today, today + timedelta(days=1)))
+        logger.info(f"Stock snapshots built: {stock_snapshots.stats()}")
+    except Exception as e:
+        # スナップショットがなくても初回アクセス時に作るので起動は止めない
+        logger.warning(f"Stock snapshot build failed: {e}", exc_info=True)
+
+# 在庫のライブ配信の設定
+STOCK_STREAM_QUEUE_SIZE = int(os.getenv('STOCK_STREAM_QUEUE_SIZE', '64'))
+STOCK_STREAM_MAX_SUBSCRIBERS = int(os.getenv('STOCK_STREAM_MAX_SUBSCRIBERS', '1000'))
+STOCK_STREAM_HEARTBEAT = float(os.getenv('STOCK_STREAM_HEARTBEAT', '15'))
+# 他のワーカーでの在庫変更を拾うためにスナップショットと突き合わせる間隔
+STOCK_STREAM_RESYNC_INTERVAL = float(os.getenv('STOCK_STREAM_RESYNC_INTERVAL', str(max(STOCK_SNAPSHOT_TTL, 5))))
+
+# SSEのイベントを組み立てる
+def sse_event(event_name: str, data: bytes) -> bytes:
+    return b"event: " + event_name.encode() + b"\ndata: " + data + b"\n\n"
+
+# 配信先1件分（送りきれないほど溜まったら差分を捨てて全件を送り直す）
+class StockSubscriber:
+    __slots__ = ("key", "queue", "overflowed")
+
+    def __init__(self, key, queue_size: int):
+        self.key = key
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+# 日付・カテゴリーごとの配信チャンネル（在庫ID → 現在の個数）
+class StockChannel:
+    __slots__ = ("subscribers", "pieces")
+
+    def __init__(self):
+        self.subscribers = set()
+        self.pieces = {}
+
+# 在庫の変化を購読者へ配信する（変化1回につきシリアライズ1回で全員に配る）
+class StockStreamHub:
+    def __init__(self, queue_size: int, max_subscribers: int, resync_interval: float):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.resync_interval = resync_interval
+        self.published = 0
+        self.overflows = 0
+        self.resyncs = 0
+        self._channels = {}
+        self._channel_by_stock = {}
+        self._loop = None
+        self._resync_wakeup = None
+        self._resync_task = None
+
+    @property
+    def subscriber_count(self):
+        return sum(len(channel.subscribers) for channel in self._channels.values())
+
+    # 購読を開始し、最初に送るスナップショットと購読者を返す
+    async def subscribe(self, target_date, category: str):
+        if self.subscriber_count >= self.max_subscribers:
+            raise HTTPException(status_code=503, detail="Too many stock stream subscribers", headers={"Retry-After": "5"})
+        self._start()
+        key = (target_date, category)
+        snapshot = await stock_snapshots.get(target_date, category)
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = StockChannel()
+        self._sync_channel(key, channel, snapshot)
+        subscriber = StockSubscriber(key, self.queue_size)
+        channel.subscribers.add(subscriber)
+        return snapshot, subscriber
+
+    def unsubscribe(self, subscriber: StockSubscriber):
+        channel = self._channels.get(subscriber.key)
+        if channel is None:
+            return
+        channel.subscribers.discard(subscriber)
+        if not channel.subscribers:
+            del self._channels[subscriber.key]
+            for stock_id in channel.pieces:
+                if self._channel_by_stock.get(stock_id) == subscriber.key:
+                    del self._channel_by_stock[stock_id]
+
+    # 最新のスナップショットに合わせ、違っていた在庫だけを配信する
+    def _sync_channel(self, key, channel: StockChannel, snapshot: StockSnapshot):
+        pieces = {row["ID"]: row["PIECES"] for row in snapshot.rows}
+        changes = [{"ID": stock_id, "PIECES": value} for stock_id, value in pieces.items() if channel.pieces.get(stock_id, value) != value]
+        for stock_id in channel.pieces.keys() - pieces.keys():
+            self._channel_by_stock.pop(stock_id, None)
+        channel.pieces = pieces
+        for stock_id in pieces:
+            self._channel_by_stock[stock_id] = key
+        if changes:
+            self._broadcast(channel, changes)
+
+    def _broadcast(self, channel: StockChannel, changes: list):
+        message = sse_event("stock", dumps_json({"changes": changes}))
+        self.published += 1
+        for subscriber in channel.subscribers:
+            if subscriber.overflowed:
+                continue
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+                self.overflows += 1
+
+    # 購読者が取り出す次のメッセージ（溜まりすぎていたら全件の個数を送り直す。Noneなら終了）
+    def resync_message(self, subscriber: StockSubscriber):
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.overflowed = False
+        channel = self._channels.get(subscriber.key)
+        pieces = channel.pieces if channel is not None else {}
+        return sse_event("stock", dumps_json({"changes": [{"ID": stock_id, "PIECES": value} for stock_id, value in pieces.items()]}))
+
+    # コミットされた在庫の減算を配信する（同期セッションからはイベントループへ渡す）
+    def publish_decrements(self, quantities: dict):
+        self._dispatch(self._publish_decrements, dict(quantities))
+
+    def _publish_decrements(self, quantities: dict):
+        changes_by_key = {}
+        for stock_id, quantity in quantities.items():
+            key = self._channel_by_stock.get(stock_id)
+            channel = self._channels.get(key) if key is not None else None
+            if channel is None:
+                continue
+            channel.pieces[stock_id] -= quantity
+            changes_by_key.setdefault(key, []).append({"ID": stock_id, "PIECES": channel.pieces[stock_id]})
+        for key, changes in changes_by_key.items():
+            self._broadcast(self._channels[key], changes)
+
+    # 入荷などでスナップショットが破棄されたら、すぐに突き合わせる
+    def request_resync(self):
+        self._dispatch(lambda: self._resync_wakeup.set())
+
+    def _dispatch(self, callback, *args):
+        if self._loop is None:
+            # まだ誰も購読していない
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _start(self):
+        if self._resync_task is None or self._resync_task.done():
+            self._loop = asyncio.get_running_loop()
+            self._resync_wakeup = asyncio.Event()
+            self._resync_task = asyncio.create_task(self._resync_loop())
+
+    # 購読中のチャンネルを定期的にスナップショットと突き合わせる（チャンネルごとに1回の読み込み）
+    async def _resync_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._resync_wakeup.wait(), self.resync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._resync_wakeup.clear()
+            if not self._channels:
+                continue
+            try:
+                for key in list(self._channels):
+                    snapshot = await stock_snapshots.get(*key)
+                    channel = self._channels.get(key)
+                    if channel is not None:
+                        self._sync_channel(key, channel, snapshot)
+                self.resyncs += 1
+            except Exception as e:
+                logger.warning(f"Stock stream resync failed: {e}", exc_info=True)
+
+    # 終了時に全購読者の配信を終わらせる
+    async def close(self):
+        for channel in self._channels.values():
+            for subscriber in channel.subscribers:
+                subscriber.overflowed = False
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+        if self._resync_task is not None:
+            self._resync_task.cancel()
+            self._resync_task = None
+
+    def stats(self):
+        return {
+            "channels": len(self._channels),
+            "subscribers": self.subscriber_count,
+            "published": self.published,
+            "overflows": self.overflows,
+            "resyncs": self.resyncs,
+        }
+
+stock_hub = StockStreamHub(STOCK_STREAM_QUEUE_SIZE, STOCK_STREAM_MAX_SUBSCRIBERS, STOCK_STREAM_RESYNC_INTERVAL)
 # UserCreate モデルの定義
 class UserCreate(BaseModel):
     username: str
@@ -263,19 +1896,160 @@ def read_root():
 def hash_password(password):
     return pwd_context.hash(password)
 
+# パスワードを検証し、設定と違うコストのハッシュなら作り直したハッシュも返す
+def verify_password(password, hashed_password):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+# bcryptの計算をリクエスト処理とは別のプロセスで行う（同時に待てる数には上限を設ける）
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', '32'))
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._executor = None
+
+    def _get_executor(self):
+        # 0ならプロセスを使わずスレッドで計算する
+        if self.workers <= 0:
+            return None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def _run(self, fn, *args):
+        # 待ちが上限を超えたらすぐに503を返す
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login requests, please retry",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            for attempt in range(2):
+                executor = self._get_executor()
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+                except BrokenProcessPool:
+                    # ワーカープロセスが落ちたプールは使えないので作り直し、1回だけやり直す
+                    logger.warning("Password hash worker pool is broken, restarting it", exc_info=True)
+                    self._drop_executor(executor)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Password hashing is temporarily unavailable, please retry",
+                headers={"Retry-After": "1"},
+            )
+        finally:
+            self.pending -= 1
+
+    # 壊れたプールを捨てる（同時に失敗した他のリクエストが作り直した新しいプールは残す）
+    def _drop_executor(self, executor):
+        if executor is not None and self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, hashed_password: str):
+        return await self._run(verify_password, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+# 番号をまとめて確保し、ワーカー内で1つずつ払い出す採番（hi-lo方式）
+# 確保した範囲の残りはワーカーの再起動で欠番になる
+EMPLOYEE_ID_BLOCK_SIZE = int(os.getenv('EMPLOYEE_ID_BLOCK_SIZE', '100'))
+
+class BlockIdAllocator:
+    def __init__(self, name: str, block_size: int, initial_value_query):
+        self.name = name
+        self.block_size = block_size
+        # 採番テーブルに行がない時の最初の番号（既存データの最大値＋1）
+        self.initial_value_query = initial_value_query
+        self.blocks = 0
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def next_id(self) -> int:
+        async with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = await self._claim_block()
+            value = self._next
+            self._next += 1
+            return value
+
+    # 採番テーブルの値をブロックの大きさだけ進め、その範囲を自分のものにする（短いトランザクション）
+    async def _claim_block(self):
+        async with AsyncSessionLocal() as db:
+            claim = (
+                update(IdSequence)
+                .where(IdSequence.NAME == self.name)
+                .values(NEXT_VALUE=IdSequence.NEXT_VALUE + self.block_size)
+                .execution_options(synchronize_session=False)
+            )
+            if (await db.execute(claim)).rowcount == 0:
+                await db.rollback()
+                await self._create_sequence(db)
+                await db.execute(claim)
+            end = (await db.execute(select(IdSequence.NEXT_VALUE).where(IdSequence.NAME == self.name))).scalar_one()
+            await db.commit()
+        self.blocks += 1
+        return end - self.block_size, end
+
+    async def _create_sequence(self, db: AsyncSession):
+        initial_value = ((await db.execute(self.initial_value_query)).scalar() or 0) + 1
+        try:
+            await db.execute(insert(IdSequence).values(NAME=self.name, NEXT_VALUE=initial_value))
+            await db.commit()
+        except IntegrityError:
+            # 他のワーカーが先に作った
+            await db.rollback()
+
+    def stats(self):
+        return {"blocks": self.blocks, "remaining": self._end - self._next, "block_size": self.block_size}
+
+employee_id_allocator = BlockIdAllocator("users.employee_Id", EMPLOYEE_ID_BLOCK_SIZE, select(func.max(User.employee_Id)))
+
 @app.post("/users/")
-def create_user(user: UserCreate, db: Session = Depends(get_db_connection)):
-    db_user = db.query(User).filter(User.EMAIL == user.email).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = hash_password(user.password)
-    max_id = db.query(func.max(User.employee_Id)).scalar() or 0
-    new_id = max_id + 1
-    db_user = User(USER_NAME=user.username, EMAIL=user.email, PASSWORD=hashed_password,employee_Id=new_id)
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    hashed_password = await password_hasher.hash(user.password)
+    employee_id = await employee_id_allocator.next_id()
+    db_user = User(USER_NAME=user.username, EMAIL=user.email, PASSWORD=hashed_password, employee_Id=employee_id)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
+    # メールアドレスの重複はユニーク制約で判定する（事前のSELECTはしない）
+    try:
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        if "EMAIL" in str(e.orig):
+            raise HTTPException(status_code=400, detail="Email already registered")
+        raise
+    # パスワードのハッシュは返さない
+    return public_user(db_user)
 
 #ログイン
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -289,30 +2063,76 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return encoded_jwt
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(User).filter(User.USER_NAME == username).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = (await db.execute(select(User).filter(User.USER_NAME == username))).scalars().first()
     if not user:
         return False
-    if not pwd_context.verify(password, user.PASSWORD):
+    verified, new_hash = await password_hasher.verify(password, user.PASSWORD)
+    if not verified:
         return False
+    if new_hash:
+        # BCRYPT_ROUNDSが変わっていたらログインのついでにハッシュを作り直す
+        user.PASSWORD = new_hash
+        await db.commit()
     return user
 
 @app.post("/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db_connection)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=401, detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if user.IS_ACTIVE is False:
+        raise HTTPException(status_code=400, detail="Inactive user")
     access_token_expires = timedelta(minutes=15)
+    # フロントで使う識別子だけをトークンに含める（メールアドレスなどの個人情報や、変わりうる有効・無効は入れない）
     access_token = create_access_token(
-        data={"sub": user.USER_NAME}, expires_delta=access_token_expires
+        data={
+            "sub": user.USER_NAME,
+            "user_id": user.ID,
+            "employee_Id": user.employee_Id,
+        },
+        expires_delta=access_token_expires,
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+# トークンのユーザーIDごとのユーザー情報キャッシュ（トークン自体は毎回署名と期限を検証する）
+# ORMでの更新・削除はコミット後に破棄する。それ以外（SQLでの直接更新や他のワーカー）での無効化はTTLの間だけ遅れる
+USER_CLAIMS_CACHE_TTL = float(os.getenv('USER_CLAIMS_CACHE_TTL', '300'))
+user_claims_cache = TTLCache(int(os.getenv('USER_CLAIMS_CACHE_MAXSIZE', '10000')), USER_CLAIMS_CACHE_TTL)
+
+# レスポンス用のユーザー情報（パスワードは含めない）
+def public_user(user: User):
+    return {
+        "ID": user.ID,
+        "USER_NAME": user.USER_NAME,
+        "EMAIL": user.EMAIL,
+        "IS_ACTIVE": user.IS_ACTIVE,
+        "employee_Id": user.employee_Id,
+    }
+
+# ユーザーの更新・削除をフラッシュ時に記録し、コミット後にキャッシュから外す
+def _record_user_changes(session, flush_context):
+    changed = session.info.setdefault("changed_users", set())
+    for obj in (*session.dirty, *session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.ID)
+
+def _invalidate_user_claims(session):
+    for user_id in session.info.pop("changed_users", ()):
+        user_claims_cache.invalidate(user_id)
+
+def _discard_user_changes(session):
+    session.info.pop("changed_users", None)
+
+event.listen(Session, "after_flush", _record_user_changes)
+event.listen(Session, "after_commit", _invalidate_user_claims)
+event.listen(Session, "after_rollback", _discard_user_changes)
+
 #ユーザー情報取得
-def get_user_from_token(db: Session, token: str):
+async def get_user_from_token(db: AsyncSession, token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -320,18 +2140,32 @@ def get_user_from_token(db: Session, token: str):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    
-    user = db.query(User).filter(User.USER_NAME == username).first()
+
+    user_id = payload.get("user_id")
+    user = user_claims_cache.get(user_id) if user_id is not None else None
     if user is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        if user_id is not None:
+            # 有効・無効とメールアドレスはトークンに入れていないので、主キーでDBから引いてキャッシュする
+            db_user = await db.get(User, user_id)
+        else:
+            # ユーザーIDを含まない古いトークンは毎回DBから取得
+            db_user = (await db.execute(select(User).filter(User.USER_NAME == username))).scalars().first()
+        if db_user is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        user = public_user(db_user)
+        if user_id is not None:
+            user_claims_cache.set(user_id, user)
+    # IS_ACTIVEが未設定（NULL）の古いユーザーは有効として扱う（カラムの既定値はTrue）
+    if user["IS_ACTIVE"] is False:
+        raise HTTPException(status_code=400, detail="Inactive user")
     return user
 
 #トークンを発行するエンドポイント指定
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 @app.get("/users/me")
-def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db_connection)):
-    user = get_user_from_token(db, token)
+async def read_users_me(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    user = await get_user_from_token(db, token)
     return user
 
 # 在庫情報をとってくる
@@ -339,30 +2173,39 @@ def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get
 async def stock_product(
     date: str,
     category: str,
-    db: Session = Depends(get_db_connection)):
-    client_date = datetime.strptime(date, '%Y-%m-%d')
-    formatted_date = client_date.strftime('%Y-%m-%d')
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    stream: bool = False,
+    compact: bool = False):
+    client_date = datetime.strptime(date, '%Y-%m-%d').date()
 
     try:
-        # with文を使って、データベースへの接続を自動的に閉じるようにする
-        with db:
-            # stocksTable内のDateが一致するレコードを取得
-            date_id = db.query(Date).filter_by(DATE = formatted_date).first()
-            category_id = db.query(Category).filter_by(NAME = category).first()
-            categorizedProducts = db.query(Product).filter_by(CATEGORY_ID = category_id.ID).all()
-            stocks = db.query(ProductStocks).filter_by(DATE_ID = date_id.ID).all()
-
-            # PRD_ID に対応する製品レコードをデータベースから取得
-            if stocks:
-                combined_data = []
-                for stock in stocks:
-                    product_data = next((product for product in categorizedProducts if product.ID == stock.PRD_ID), None)
-                    if product_data is not None:
-                        stock_dict = to_dict(stock)
-                        product_dict = to_dict(product_data)
-                        combined_dict = {**product_dict, **stock_dict}  # 最古情報と商品情報の2つの辞書を結合
-                        combined_data.append(combined_dict)
-                return {"status": "success", "data": combined_data}
+        # 在庫スナップショットがあればシリアライズ済みの本文をそのまま返す
+        if STOCK_SNAPSHOT_TTL > 0 and not stream:
+            snapshot = await stock_snapshots.get(client_date, category)
+            if limit is None and not offset:
+                return Response(snapshot.compact_body if compact else snapshot.body, media_type="application/json")
+            rows = snapshot.compact_rows() if compact else snapshot.rows
+            end = None if limit is None else offset + limit
+            return FastJSONResponse({"status": "success", "data": rows[offset:end]})
+
+        # 在庫・商品・日付・カテゴリーを結合して必要なカラムだけを取得（compactなら画像・説明を省く）
+        columns = project_columns(STOCK_PRODUCT_COLUMNS) if compact else STOCK_PRODUCT_COLUMNS
+        query = build_stock_product_query(client_date, category, columns)
+        # ページングの指定があれば適用
+        if limit is not None or offset:
+            query = query.limit(limit).offset(offset)
+
+        # 大きな店舗向けに結果を逐次JSONで返す
+        if stream:
+            return StreamingResponse(stream_stock_product(query), media_type="application/json")
+
+        # 同じ条件の読み込みが同時に来たら1回のクエリの結果を共有する
+        flight_key = ("rows", client_date, category, compact, limit, offset)
+        combined_data = await stock_flights.do(flight_key, lambda: fetch_stock_rows(query))
+        return FastJSONResponse({"status": "success", "data": combined_data})
+    except HTTPException:
+        raise
     # 例外が発生した場合
     except Exception as e:
         # ログにエラーを出力
@@ -374,18 +2217,133 @@ async def stock_product(
         # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
         raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
 
+# 在庫一覧を読み込む（共有の読み込みから呼ぶので自分でセッションを開く）
+async def fetch_stock_rows(query):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(query)
+        keys = tuple(result.keys())
+        return [dict(zip(keys, row)) for row in result]
+
+# 在庫一覧をサーバーサイドカーソルで読みながらJSONとして送る
+# （レスポンス送信中もセッションが必要なので依存関係とは別にセッションを開く）
+async def stream_stock_product(query):
+    yield b'{"status":"success","data":['
+    try:
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(query)
+            keys = tuple(result.keys())
+            first = True
+            async for row in result:
+                chunk = dumps_json(dict(zip(keys, row)))
+                yield chunk if first else b"," + chunk
+                first = False
+    except Exception as e:
+        # ヘッダー送信後なのでステータスは変えられない。ログだけ出して閉じる
+        logger.error(f"A stock stream error occurred: {e}", exc_info=True)
+    yield b']}'
+
+# 在庫情報（GET版）。在庫スナップショットのETagで確認し、変わっていなければ304を返す
+@app.get("/Stocks/")
+async def get_stock_product(
+    request: Request,
+    date: str,
+    category: str,
+    compact: bool = False):
+    client_date = datetime.strptime(date, '%Y-%m-%d').date()
+    try:
+        snapshot = await stock_snapshots.get(client_date, category)
+        body, etag = (snapshot.compact_body, snapshot.compact_etag) if compact else (snapshot.body, snapshot.etag)
+        # 在庫は会計ごとに変わるので、キャッシュしても毎回ETagで確認させる
+        return conditional_json_response(request, body, etag, "no-cache")
+    except HTTPException:
+        raise
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A stock list error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+
+# 在庫のライブ配信（SSE）。最初に在庫一覧を送り、その後は個数が変わった在庫だけを送る
+#   event: snapshot  /Stocks/と同じ形式の一覧
+#   event: stock     {"changes": [{"ID": 在庫ID, "PIECES": 個数}, ...]}
+@app.get("/Stocks/stream")
+async def stock_stream(
+    date: str,
+    category: str,
+    compact: bool = False):
+    client_date = datetime.strptime(date, '%Y-%m-%d').date()
+    try:
+        # スナップショットは共有の読み込みで作られるので、このエンドポイントはセッションを持たない
+        snapshot, subscriber = await stock_hub.subscribe(client_date, category)
+    except HTTPException:
+        raise
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A stock stream error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+    return StreamingResponse(
+        stream_stock_events(subscriber, snapshot.compact_body if compact else snapshot.body),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def stream_stock_events(subscriber: StockSubscriber, snapshot_body: bytes):
+    try:
+        yield b"retry: 3000\n" + sse_event("snapshot", snapshot_body)
+        while True:
+            if subscriber.overflowed:
+                yield stock_hub.resync_message(subscriber)
+                continue
+            try:
+                message = await asyncio.wait_for(subscriber.queue.get(), STOCK_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # 接続を維持するためのコメント行
+                yield b": keep-alive\n\n"
+                continue
+            if message is None:
+                break
+            yield message
+    finally:
+        stock_hub.unsubscribe(subscriber)
+
+
+# 商品を読み込む（共有の読み込みから呼ぶので自分でセッションを開く）
+async def load_product(product_id: int):
+    async with AsyncSessionLocal() as db:
+        return await reference_cache.get_product(db, product_id)
+
+# 商品詳細のレスポンス本文を作って保存する（商品がなければNone）
+async def load_product_response(product_id: int, version: int):
+    product = await load_product(product_id)
+    if product is None:
+        return None
+    body = dumps_json({"status": "success", "data": to_dict(product)})
+    cached = (version, make_etag(body), body)
+    product_responses.set(product_id, cached)
+    return cached
 
 # 商品詳細ページ（商品をタップした時）
 @app.post("/Products/")
 # クエリパラメータとしてproduct_idを取得する
 async def product_detail(
-    ID: int, 
-    db: Session = Depends(get_db_connection)):
+    ID: int):
     try:
-        with db:
-            # プロダクトIDが一致する商品詳細情報を取得
-            product = db.query(Product).filter(Product.ID == ID).first()
-            return {"status": "success", "data": product}
+        # プロダクトIDが一致する商品詳細情報を取得（同時に来た同じ商品の読み込みは1回にまとめる）
+        product = await product_flights.do(("product", ID), lambda: load_product(ID))
+        return {"status": "success", "data": product}
+    except HTTPException:
+        raise
     # 例外が発生した場合
     except Exception as e:
         # ログにエラーを出力
@@ -397,31 +2355,57 @@ async def product_detail(
         # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
         raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
     
+# 商品詳細（GET版）。ETagが一致すれば304を返し、ブラウザやプロキシでもキャッシュできる
+@app.get("/Products/")
+async def get_product_detail(
+    request: Request,
+    ID: int):
+    try:
+        version = table_versions["Product"]
+        cached = product_responses.get(ID)
+        if cached is None or cached[0] != version:
+            # 同時に来た同じ商品の読み込み・シリアライズは1回にまとめる
+            cached = await product_flights.do(("response", ID, version), lambda: load_product_response(ID, version))
+            if cached is None:
+                raise HTTPException(status_code=404, detail="Product not found")
+        _, etag, body = cached
+        return conditional_json_response(request, body, etag, f"public, max-age={PRODUCT_CACHE_MAX_AGE}")
+    except HTTPException:
+        raise
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A product detail error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+
 
 # 予約リストに追加（=購入ボタンを押した時）
 @app.post("/Reservation/")
 async def create_ReservationData(
     postReservationData: ReservationData = Body(...), 
-    db: Session = Depends(get_db_connection)):
+    db: AsyncSession = Depends(get_async_db)):
     try:
-        # with文を使って、データベースへの接続を自動的に閉じるようにする
-        with db:
-            # 指定された型でdbへのレコード追加用の情報を作る
-            RSV = Reservation(
-                RSV_TIME = postReservationData.RSV_TIME, 
-                STOCK_ID = postReservationData.STOCK_ID, 
-                USER_ID = postReservationData.USER_ID, 
-                MY_COUPON_ID = postReservationData.MY_COUPON_ID,
-                MET = postReservationData.MET,
-                DATE = postReservationData.DATE,
-            )
-            # db追加
-            db.add(RSV)
-            db.commit()
-            # 自動採番されたRSV.IDを取得
-            rsv_id = RSV.ID
-            # RSV.IDをレスポンスに含める
-            return {"RSV_ID": rsv_id }
+        # 指定された型でdbへのレコード追加用の情報を作る
+        RSV = Reservation(
+            RSV_TIME = postReservationData.RSV_TIME, 
+            STOCK_ID = postReservationData.STOCK_ID, 
+            USER_ID = postReservationData.USER_ID, 
+            MY_COUPON_ID = postReservationData.MY_COUPON_ID,
+            MET = postReservationData.MET,
+            DATE = postReservationData.DATE,
+        )
+        # db追加
+        db.add(RSV)
+        await db.commit()
+        # 自動採番されたRSV.IDを取得
+        rsv_id = RSV.ID
+        # RSV.IDをレスポンスに含める
+        return {"RSV_ID": rsv_id }
     # 例外が発生した場合
     except Exception as e:
         # ログにエラーを出力
@@ -438,31 +2422,33 @@ async def create_ReservationData(
 @app.post("/CouponReservation/")
 async def create_ReservationData(
     postReservationData: ReservationData = Body(...), 
-    db: Session = Depends(get_db_connection)):
+    db: AsyncSession = Depends(get_async_db)):
     try:
-        # with文を使って、データベースへの接続を自動的に閉じるようにする
-        with db:
-            # 指定された型でdbへのレコード追加用の情報を作る
-            RSV = Reservation(
-                RSV_TIME = postReservationData.RSV_TIME, 
-                STOCK_ID = postReservationData.STOCK_ID, 
-                USER_ID = postReservationData.USER_ID, 
-                MY_COUPON_ID = postReservationData.MY_COUPON_ID,
-                MET = postReservationData.MET,
-                DATE = postReservationData.DATE,
-            )
-            # db追加
-            db.add(RSV)
-            db.commit()
-            # 自動採番されたRSV.IDを取得
-            rsv_id = RSV.ID
-            # MyCouponテーブルからIDがRSV_STOCK_IDと完全一致するデータを検索し、STATUSを1から2に変更する 
-            my_coupon = db.query(MyCoupon).filter(MyCoupon.ID == postReservationData.MY_COUPON_ID).first()
-            if my_coupon:
-                my_coupon.STATUS = 2
-                db.commit()
-            # RSV.IDをレスポンスに含める
-            return {"RSV_ID": rsv_id }
+        # 指定された型でdbへのレコード追加用の情報を作る
+        RSV = Reservation(
+            RSV_TIME = postReservationData.RSV_TIME, 
+            STOCK_ID = postReservationData.STOCK_ID, 
+            USER_ID = postReservationData.USER_ID, 
+            MY_COUPON_ID = postReservationData.MY_COUPON_ID,
+            MET = postReservationData.MET,
+            DATE = postReservationData.DATE,
+        )
+        # db追加
+        db.add(RSV)
+        # MyCouponテーブルからIDがMY_COUPON_IDと完全一致するデータのSTATUSを1から2に変更する（予約と同じトランザクション）
+        await db.execute(
+            update(MyCoupon)
+            .where(MyCoupon.ID == postReservationData.MY_COUPON_ID)
+            .values(STATUS=2)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        # ステータスが変わったのでマイクーポン一覧のキャッシュを破棄
+        invalidate_my_coupon_cache(postReservationData.USER_ID)
+        # 自動採番されたRSV.IDを取得
+        rsv_id = RSV.ID
+        # RSV.IDをレスポンスに含める
+        return {"RSV_ID": rsv_id }
     # 例外が発生した場合
     except Exception as e:
         # ログにエラーを出力
@@ -475,20 +2461,64 @@ async def create_ReservationData(
         raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
 
 
+# 予約をまとめて追加（商品とクーポンが混在したリストを1回のコミットで登録）
+@app.post("/Reservation/bulk/")
+async def create_ReservationDataBulk(
+    postReservationData: List[ReservationData] = Body(...),
+    db: AsyncSession = Depends(get_async_db)):
+    try:
+        if not postReservationData:
+            return {"RSV_IDS": []}
+        # 予約をまとめて登録し、自動採番されたIDを送られてきた順に取得
+        rsv_ids = await bulk_insert_returning_ids(db, Reservation, [
+            {
+                "RSV_TIME": item.RSV_TIME,
+                "STOCK_ID": item.STOCK_ID,
+                "USER_ID": item.USER_ID,
+                "MY_COUPON_ID": item.MY_COUPON_ID,
+                "MET": item.MET,
+                "DATE": item.DATE,
+            }
+            for item in postReservationData
+        ])
+        # クーポンの予約（STOCK_IDが9999）はマイクーポンのSTATUSを1回のUPDATEで2に変更する
+        coupon_items = [item for item in postReservationData if item.STOCK_ID == 9999]
+        if coupon_items:
+            await db.execute(
+                update(MyCoupon)
+                .where(MyCoupon.ID.in_({int(item.MY_COUPON_ID) for item in coupon_items}))
+                .values(STATUS=2)
+                .execution_options(synchronize_session=False)
+            )
+        await db.commit()
+        for user_id in {item.USER_ID for item in coupon_items}:
+            invalidate_my_coupon_cache(user_id)
+        return {"RSV_IDS": rsv_ids}
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A reservation bulk error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+
+
 # 予約リストを表示する
 @app.get("/Reservation/")
 # クエリパラメータとしてuser_id、dateを取得する
 async def reservation_product(
     user_id: str, 
     date: Optional[str] = None,
-    db: Session = Depends(get_db_connection)):
+    compact: bool = False,
+    db: AsyncSession = Depends(get_async_db)):
     # strで送られてきているのでdate型に変換する
     if date is None or date == 'undefined':
         client_date = datetime.now()
-        formatted_date = client_date.strftime('%Y-%m-%d')
     else:
         client_date = datetime.strptime(date, '%Y-%m-%d')
-        formatted_date = client_date.strftime('%Y-%m-%d')
     # CouponをProductのモデルに合うようにデータ加工
     def convert_coupon_to_product(coupon):
         return {
@@ -504,40 +2534,45 @@ async def reservation_product(
             "CATEGORY_ID": None,
         }
     try:
-        with db:
-            # ユーザーIDが一致する予約情報を取得
-            reservations = db.query(Reservation).filter(Reservation.USER_ID == user_id).all()
-            # date_idを取得
-            date_id = db.query(Date).filter_by(DATE = formatted_date).first()
-            # 予約リストから STOCK_ID, MY_COUPON_ID を取得
-            stk_ids = [reservation.STOCK_ID for reservation in reservations]
-            myc_ids = [reservation.MY_COUPON_ID for reservation in reservations]
-            RSVdates = [reservation.DATE for reservation in reservations]
-            # PRD_ID に対応する製品レコードをデータベースから取得
-            products = []
-            for stk_id, myc_id, RSVdate in zip(stk_ids, myc_ids, RSVdates):
-                if stk_id != 9999:
-                    # stockTableのIDとstk_id、date_idが両方一致するもののみをstockに格納
-                    stock = db.query(ProductStocks).filter(ProductStocks.ID == stk_id).filter(ProductStocks.DATE_ID == date_id.ID).first()
-                    if stock:
-                        # stockのidとPRD_IDが一致する商品情報をproductsの配列に追加
-                        product = db.query(Product).filter(Product.ID == stock.PRD_ID).first()
-                        products.append(product)
-                else:
-                    if RSVdate == date: 
-                        # stk_idが9999の場合、my_couponsTableからIDとmyc_idが一致するものを抽出
-                        my_coupon = db.query(MyCoupon).filter(MyCoupon.ID == myc_id).first()
-                        if my_coupon:
-                            # 抽出データのCOUPON_IDと一致するクーポンをcouponsTableから取得
-                            coupon = db.query(Coupon).filter(Coupon.ID == my_coupon.COUPON_ID).first()
-                            product = convert_coupon_to_product(coupon)
-                            products.append(product)
-                #else:
-                    # 製品が見つからなかった場合は次のfor文へ
-                    # continue
-                    # ここではエラーを発生させる例を示します
-                    # raise HTTPException(status_code=404, detail=f"Product with PRD_ID {stk_id} not found")
-            return {"status": "success", "data": products}
+        # 在庫の予約：予約・在庫・日付・商品を結合し、日付の絞り込みもSQLで行う
+        stock_query = (
+            select(Reservation.ID, Product)
+            .join(ProductStocks, ProductStocks.ID == Reservation.STOCK_ID)
+            .join(Date, Date.ID == ProductStocks.DATE_ID)
+            .join(Product, Product.ID == ProductStocks.PRD_ID)
+            .where(
+                Reservation.USER_ID == user_id,
+                Reservation.STOCK_ID != 9999,
+                Date.DATE == client_date.date(),
+            )
+        )
+        # compactなら画像・説明を省く
+        exclude = LIST_VIEW_EXCLUDE if compact else ()
+        product_serializer = get_serializer(Product, exclude)
+        reserved = [(rsv_id, product_serializer(product)) for rsv_id, product in (await db.execute(stock_query)).all()]
+
+        # クーポンの予約（STOCK_IDが9999）：予約日が一致するものをマイクーポン・クーポンと結合して取得
+        if date is not None and date != 'undefined':
+            coupon_query = (
+                select(Reservation.ID, Coupon)
+                .join(MyCoupon, MyCoupon.ID == Reservation.MY_COUPON_ID)
+                .join(Coupon, Coupon.ID == MyCoupon.COUPON_ID)
+                .where(
+                    Reservation.USER_ID == user_id,
+                    Reservation.STOCK_ID == 9999,
+                    Reservation.DATE == date,
+                )
+            )
+            for rsv_id, coupon in (await db.execute(coupon_query)).all():
+                product = convert_coupon_to_product(coupon)
+                for column in exclude:
+                    product.pop(column, None)
+                reserved.append((rsv_id, product))
+
+        # 予約した順に並べる
+        reserved.sort(key=lambda item: item[0])
+        products = [product for _, product in reserved]
+        return FastJSONResponse({"status": "success", "data": products})
     # 例外が発生した場合
     except Exception as e:
         # ログにエラーを出力
@@ -550,27 +2585,130 @@ async def reservation_product(
         raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
 
 
+# 履歴のページング（新しい順。(DATE, ID)のカーソルで続きを取得する）
+HISTORY_DEFAULT_LIMIT = 20
+HISTORY_MAX_LIMIT = 100
+
+# カーソルは最後に返した行の [DATE, ID] をJSONにしてURLで使える文字列にしたもの
+# DATEがNULLの行や、予約のDATE（文字列）がISO形式でない古いデータでも続きを取れるよう、値はそのまま入れる
+def encode_cursor(date_value, row_id: int) -> str:
+    if isinstance(date_value, date):
+        date_value = date_value.isoformat()
+    raw = json.dumps([date_value, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# parse_dateを指定するとDATEをその関数で変換する（DATE型のカラム用）
+def decode_cursor(cursor: str, parse_date=None):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        date_value, row_id = json.loads(raw)
+        if not isinstance(row_id, int) or isinstance(row_id, bool) or not (date_value is None or isinstance(date_value, str)):
+            raise ValueError(raw)
+        if date_value is not None and parse_date is not None:
+            date_value = parse_date(date_value)
+        return date_value, row_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# 新しい順に並べた時にカーソルより後ろの行だけを取る条件（インデックスの範囲検索になる形で書く）
+# DATEの降順ではNULLの行が最後に来る（MySQL・SQLiteともにNULLは最小の値として並ぶ）ので、
+# NULLの行はDATEがあるどのカーソルよりも後ろ、NULL同士はIDの降順とする
+def after_cursor(date_column, id_column, cursor_date, cursor_id):
+    if cursor_date is None:
+        return and_(date_column.is_(None), id_column < cursor_id)
+    return or_(
+        date_column < cursor_date,
+        and_(date_column == cursor_date, id_column < cursor_id),
+        date_column.is_(None),
+    )
+
+# limit+1件読んで、続きがあれば次のカーソルを付けて返す
+async def history_page(db: AsyncSession, query, limit: int):
+    result = await db.execute(query.limit(limit + 1))
+    keys = tuple(result.keys())
+    rows = [dict(zip(keys, row)) for row in result]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["DATE"], rows[-1]["ID"])
+    return FastJSONResponse({"status": "success", "data": rows, "next_cursor": next_cursor})
+
+# 予約履歴（商品の予約は商品情報、クーポンの予約はクーポン情報を付ける）
+@app.get("/Reservation/history")
+async def reservation_history(
+    user_id: str,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(HISTORY_DEFAULT_LIMIT, ge=1, le=HISTORY_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)):
+    # 予約のDATEは文字列（YYYY-MM-DD）なので、比較も同じ形式の文字列で行う
+    conditions = [Reservation.USER_ID == user_id]
+    if start is not None:
+        conditions.append(Reservation.DATE >= start.isoformat())
+    if end is not None:
+        conditions.append(Reservation.DATE <= end.isoformat())
+    if cursor:
+        cursor_date, cursor_id = decode_cursor(cursor)
+        conditions.append(after_cursor(Reservation.DATE, Reservation.ID, cursor_date, cursor_id))
+    try:
+        query = (
+            select(
+                Reservation.ID,
+                Reservation.DATE,
+                Reservation.RSV_TIME,
+                Reservation.STOCK_ID,
+                Reservation.MY_COUPON_ID,
+                Reservation.MET,
+                Product.ID.label("PRD_ID"),
+                Product.PRD_CODE,
+                Product.PRD_NAME,
+                Product.PRICE,
+                Coupon.ID.label("COUPON_ID"),
+                Coupon.NAME.label("COUPON_NAME"),
+                Coupon.PRICE.label("COUPON_PRICE"),
+            )
+            .outerjoin(ProductStocks, and_(Reservation.STOCK_ID != 9999, ProductStocks.ID == Reservation.STOCK_ID))
+            .outerjoin(Product, Product.ID == ProductStocks.PRD_ID)
+            .outerjoin(MyCoupon, and_(Reservation.STOCK_ID == 9999, MyCoupon.ID == Reservation.MY_COUPON_ID))
+            .outerjoin(Coupon, Coupon.ID == MyCoupon.COUPON_ID)
+            .where(*conditions)
+            .order_by(Reservation.DATE.desc(), Reservation.ID.desc())
+        )
+        return await history_page(db, query, limit)
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A reservation history error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+
+
 # マイクーポン情報取得
 @app.get("/MyCoupon/")
 # クエリパラメータとしてuser_idを取得する
 async def my_coupon(
     user_id: int, 
-    db: Session = Depends(get_db_connection)):
+    compact: bool = False,
+    db: AsyncSession = Depends(get_async_db)):
     try:
-        # with文を使って、データベースへの接続を自動的に閉じるようにする
-        with db:
-            # ユーザーIDが一致するクーポン情報を取得
-            my_coupons = db.query(MyCoupon).filter(MyCoupon.USER_ID == user_id, MyCoupon.STATUS == 1).all()
-            # USER_IDに対応するクーポンレコードをデータベースから取得
-            if my_coupons:
-                combined_my_coupon_data = []
-                for my_coupon in my_coupons:
-                    coupon_data = db.query(Coupon).filter(Coupon.ID == my_coupon.COUPON_ID).first()
-                    my_coupon_dict = to_dict(my_coupon)
-                    coupon_dict = to_dict(coupon_data)
-                    combined_dict = {**coupon_dict, **my_coupon_dict}  # クーポン情報とまいクーポン情報の2つの辞書を結合
-                    combined_my_coupon_data.append(combined_dict)
-                return {"status": "success", "data": combined_my_coupon_data}
+        if MY_COUPON_CACHE_TTL > 0:
+            cached = my_coupon_cache.get((user_id, compact))
+            if cached is not None:
+                return FastJSONResponse({"status": "success", "data": cached})
+        # ユーザーIDが一致する有効期限内のクーポン情報を、クーポンと結合して1回で取得
+        columns = project_columns(MY_COUPON_COLUMNS) if compact else MY_COUPON_COLUMNS
+        query = build_my_coupon_query(user_id, datetime.now().date(), columns)
+        result = await db.execute(query)
+        keys = tuple(result.keys())
+        combined_my_coupon_data = [dict(zip(keys, row)) for row in result]
+        if MY_COUPON_CACHE_TTL > 0:
+            my_coupon_cache.set((user_id, compact), combined_my_coupon_data)
+        return FastJSONResponse({"status": "success", "data": combined_my_coupon_data})
     # 例外が発生した場合
     except Exception as e:
         # ログにエラーを出力
@@ -583,48 +2721,575 @@ async def my_coupon(
         raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
 
 
+# マイクーポンの期限切れ処理の設定（間隔が0なら動かさない）
+COUPON_SWEEP_INTERVAL = float(os.getenv('COUPON_SWEEP_INTERVAL', '3600'))
+# 1トランザクションで更新する最大件数（ロックを長く持たないように区切る）
+COUPON_SWEEP_BATCH_SIZE = int(os.getenv('COUPON_SWEEP_BATCH_SIZE', '1000'))
+# 期限切れから何日たったら保管テーブルへ移すか（0なら移さない）
+COUPON_ARCHIVE_AFTER_DAYS = int(os.getenv('COUPON_ARCHIVE_AFTER_DAYS', '90'))
+
+# 有効期限を過ぎた未使用のマイクーポンを期限切れにし、古い期限切れのものを保管テーブルへ移す
+# 複数のワーカーで動いてもSKIP LOCKEDで同じ行を取り合わない（SQLiteでは無視される）
+class CouponExpirySweeper:
+    def __init__(self, interval: float, batch_size: int, archive_after_days: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.archive_after_days = archive_after_days
+        self.runs = 0
+        self.failures = 0
+        self.expired_total = 0
+        self.archived_total = 0
+        self.last_expired = 0
+        self.last_archived = 0
+        self.last_duration = 0.0
+        self.last_run_at = None
+        self._task = None
+
+    async def sweep(self, today=None):
+        today = today or datetime.now().date()
+        start = time.perf_counter()
+        try:
+            expired = await self._expire(today)
+            archived = await self._archive(today) if self.archive_after_days > 0 else 0
+        except Exception:
+            self.failures += 1
+            raise
+        self.runs += 1
+        self.last_expired = expired
+        self.last_archived = archived
+        self.expired_total += expired
+        self.archived_total += archived
+        self.last_duration = time.perf_counter() - start
+        self.last_run_at = datetime.now(timezone.utc)
+        logger.info(f"Coupon sweep: expired {expired}, archived {archived} in {self.last_duration:.3f}s")
+        return {"expired": expired, "archived": archived, "duration": self.last_duration}
+
+    # 期限切れにする（未使用のものだけ）
+    async def _expire(self, today) -> int:
+        total = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(
+                    select(MyCoupon.ID, MyCoupon.USER_ID)
+                    .where(MyCoupon.STATUS == 1, MyCoupon.EXP_DATE < today)
+                    .order_by(MyCoupon.STATUS, MyCoupon.EXP_DATE)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                )).all()
+                if not rows:
+                    return total
+                await db.execute(
+                    update(MyCoupon)
+                    .where(MyCoupon.ID.in_([coupon_id for coupon_id, _ in rows]), MyCoupon.STATUS == 1)
+                    .values(STATUS=MY_COUPON_EXPIRED)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+            for user_id in {user_id for _, user_id in rows}:
+                invalidate_my_coupon_cache(user_id)
+            total += len(rows)
+            # 区切りごとに他のリクエストへ順番を譲る
+            await asyncio.sleep(0)
+
+    # 期限切れから一定期間たったものを保管テーブルへ移す
+    # （使用済みのものは取引データから参照されるので移さない）
+    async def _archive(self, today) -> int:
+        cutoff = today - timedelta(days=self.archive_after_days)
+        total = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                coupons = (await db.execute(
+                    select(MyCoupon)
+                    .where(MyCoupon.STATUS == MY_COUPON_EXPIRED, MyCoupon.EXP_DATE < cutoff)
+                    .order_by(MyCoupon.STATUS, MyCoupon.EXP_DATE)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                )).scalars().all()
+                if not coupons:
+                    return total
+                archived_at = datetime.now()
+                await db.execute(insert(MyCouponArchive), [
+                    {**to_dict(coupon), "ARCHIVED_AT": archived_at} for coupon in coupons
+                ])
+                await db.execute(
+                    delete(MyCoupon)
+                    .where(MyCoupon.ID.in_([coupon.ID for coupon in coupons]))
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+            total += len(coupons)
+            await asyncio.sleep(0)
+
+    async def _run(self):
+        # 複数のワーカーが同時に始めないように少しずらす
+        await asyncio.sleep(random.uniform(0, min(60.0, self.interval)))
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning(f"Coupon sweep failed: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "expired_total": self.expired_total,
+            "archived_total": self.archived_total,
+            "last_expired": self.last_expired,
+            "last_archived": self.last_archived,
+            "last_duration": self.last_duration,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+        }
+
+coupon_sweeper = CouponExpirySweeper(COUPON_SWEEP_INTERVAL, COUPON_SWEEP_BATCH_SIZE, COUPON_ARCHIVE_AFTER_DAYS)
+
+# 在庫をまとめて減らす（在庫が足りる場合だけ減算する条件付きUPDATEを1回で実行）
+# quantitiesは {在庫ID: 減らす数}。すべての在庫が減らせた場合だけTrueを返す
+async def decrement_stocks(db: AsyncSession, quantities: dict) -> bool:
+    pieces = case(quantities, value=ProductStocks.ID)
+    result = await db.execute(
+        update(ProductStocks)
+        .where(ProductStocks.ID.in_(list(quantities)), ProductStocks.PIECES >= pieces)
+        .values(PIECES=ProductStocks.PIECES - pieces)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != len(quantities):
+        return False
+    # コミット後に在庫スナップショットへ反映する
+    db.info.setdefault("stock_decrements", Counter()).update(quantities)
+    return True
+
+# 売上集計の設定（falseなら取引の書き込み時に集計しない）
+SALES_ROLLUP_ENABLED = os.getenv('SALES_ROLLUP_ENABLED', 'true').lower() == 'true'
+# 作り直しの際に1トランザクションで処理する日数
+SALES_REBUILD_CHUNK_DAYS = int(os.getenv('SALES_REBUILD_CHUNK_DAYS', '31'))
+
+# 集計の行を主キー順に並べる（複数のレジが同じ行を更新してもロックの順番がそろう）
+def _sales_rows(totals: dict, categories: dict):
+    return [
+        {"DATE": sale_date, "PRD_ID": prd_id, "COUPON_ID": coupon_id, "CATEGORY_ID": categories.get(prd_id), "UNITS": units, "REVENUE": revenue}
+        for (sale_date, prd_id, coupon_id), (units, revenue) in sorted(totals.items())
+    ]
+
+# 売上の集計行を加算で書き込むUPSERT文（DBごとに構文が違う。対応していないDBはNone）
+def sales_upsert_statement(dialect_name: str, rows: list):
+    if dialect_name == "mysql":
+        statement = mysql_insert(SalesRollup).values(rows)
+        return statement.on_duplicate_key_update(
+            UNITS=SalesRollup.UNITS + statement.inserted.UNITS,
+            REVENUE=SalesRollup.REVENUE + statement.inserted.REVENUE,
+        )
+    if dialect_name == "sqlite":
+        statement = sqlite_insert(SalesRollup).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=[SalesRollup.DATE, SalesRollup.PRD_ID, SalesRollup.COUPON_ID],
+            set_={
+                "UNITS": SalesRollup.UNITS + statement.excluded.UNITS,
+                "REVENUE": SalesRollup.REVENUE + statement.excluded.REVENUE,
+            },
+        )
+    return None
+
+# 取引と同じトランザクションで売上集計に加算する（コミットは呼び出し側で行う）
+# salesは (日付, 商品, クーポンID, 金額) のリスト。金額は取引データのAMOUNTと同じ値を渡す
+async def record_sales(db: AsyncSession, sales):
+    if not SALES_ROLLUP_ENABLED or not sales:
+        return
+    totals = {}
+    categories = {}
+    for sale_date, product, coupon_id, amount in sales:
+        key = (sale_date, product.ID, coupon_id or 0)
+        units, revenue = totals.get(key, (0, 0))
+        totals[key] = (units + 1, revenue + (amount or 0))
+        categories[product.ID] = product.CATEGORY_ID
+    rows = _sales_rows(totals, categories)
+    statement = sales_upsert_statement(db.bind.dialect.name, rows)
+    if statement is not None:
+        await db.execute(statement)
+        return
+    # UPSERTがないDBは加算で更新し、行がなければ登録する
+    for row in rows:
+        result = await db.execute(
+            update(SalesRollup)
+            .where(SalesRollup.DATE == row["DATE"], SalesRollup.PRD_ID == row["PRD_ID"], SalesRollup.COUPON_ID == row["COUPON_ID"])
+            .values(UNITS=SalesRollup.UNITS + row["UNITS"], REVENUE=SalesRollup.REVENUE + row["REVENUE"])
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            await db.execute(insert(SalesRollup).values(row))
+
+# 取引の (日付, 商品ID, クーポンID, 金額) を集計する（NumPyがあれば配列でまとめて集計する）
+def aggregate_raw_sales(raw_rows, categories: dict):
+    if not raw_rows:
+        return []
+    if np is None:
+        totals = {}
+        for sale_date, prd_id, coupon_id, amount in raw_rows:
+            key = (sale_date, prd_id or 0, coupon_id or 0)
+            units, revenue = totals.get(key, (0, 0))
+            totals[key] = (units + 1, revenue + (amount or 0))
+        return _sales_rows(totals, categories)
+
+    count = len(raw_rows)
+    dates = np.fromiter((row[0].toordinal() for row in raw_rows), dtype=np.int64, count=count)
+    prd_ids = np.fromiter((row[1] or 0 for row in raw_rows), dtype=np.int64, count=count)
+    coupon_ids = np.fromiter((row[2] or 0 for row in raw_rows), dtype=np.int64, count=count)
+    amounts = np.fromiter((row[3] or 0 for row in raw_rows), dtype=np.int64, count=count)
+    keys, inverse, units = np.unique(np.stack((dates, prd_ids, coupon_ids), axis=1), axis=0, return_inverse=True, return_counts=True)
+    revenue = np.bincount(inverse.ravel(), weights=amounts, minlength=len(keys))
+    totals = {
+        (date.fromordinal(ordinal), prd_id, coupon_id): (unit_count, int(round(amount)))
+        for (ordinal, prd_id, coupon_id), unit_count, amount in zip(keys.tolist(), units.tolist(), revenue.tolist())
+    }
+    return _sales_rows(totals, categories)
+
+def _begin(bind):
+    # 接続が渡された場合は呼び出し側のトランザクションをそのまま使う
+    return nullcontext(bind) if isinstance(bind, Connection) else bind.begin()
+
+# 取引データから指定期間（省略時は全期間）の売上集計を作り直す
+# 期間をSALES_REBUILD_CHUNK_DAYS日ずつに区切り、区切りごとに集計行を置き換える
+# 置き換え中の日付に書き込まれた取引は反映されないことがあるので、過去の期間か取引の少ない時間に実行する
+# 売上は取引データに記録した販売時の金額で計算する（書き込み時の集計と同じ金額になる）
+# 金額が記録されていない古い取引だけは現在の商品価格で計算する
+def rebuild_sales_rollups(bind=None, start=None, end=None, chunk_days: int = SALES_REBUILD_CHUNK_DAYS):
+    bind = bind if bind is not None else engine
+    with _begin(bind) as conn:
+        first, last = conn.execute(select(func.min(TransactionData.DATE), func.max(TransactionData.DATE))).one()
+        categories = dict(conn.execute(select(Product.ID, Product.CATEGORY_ID)).all())
+    result = {"days": 0, "transactions": 0, "rows": 0, "numpy": np is not None}
+    if first is None:
+        return result
+    start = start or first
+    end = end or last
+    chunk_start = start
+    while chunk_start <= end:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end)
+        with _begin(bind) as conn:
+            raw_rows = conn.execute(
+                select(
+                    TransactionData.DATE,
+                    TransactionData.PRD_ID,
+                    MyCoupon.COUPON_ID,
+                    func.coalesce(TransactionData.AMOUNT, Product.PRICE),
+                )
+                .outerjoin(MyCoupon, MyCoupon.ID == TransactionData.MY_COUPON_ID)
+                .outerjoin(Product, Product.ID == TransactionData.PRD_ID)
+                .where(TransactionData.DATE.between(chunk_start, chunk_end))
+            ).all()
+            rows = aggregate_raw_sales(raw_rows, categories)
+            conn.execute(delete(SalesRollup).where(SalesRollup.DATE.between(chunk_start, chunk_end)))
+            if rows:
+                conn.execute(insert(SalesRollup), rows)
+        result["days"] += (chunk_end - chunk_start).days + 1
+        result["transactions"] += len(raw_rows)
+        result["rows"] += len(rows)
+        chunk_start = chunk_end + timedelta(days=1)
+    return result
+
+# 取引データの書き込みをまとめる設定（TRANSACTION_WRITE_BEHIND=trueで有効）
+TRANSACTION_WRITE_BEHIND = os.getenv('TRANSACTION_WRITE_BEHIND', 'false').lower() == 'true'
+TRANSACTION_BATCH_SIZE = int(os.getenv('TRANSACTION_BATCH_SIZE', '50'))
+TRANSACTION_BATCH_WAIT_MS = float(os.getenv('TRANSACTION_BATCH_WAIT_MS', '5'))
+TRANSACTION_QUEUE_SIZE = int(os.getenv('TRANSACTION_QUEUE_SIZE', '1000'))
+
+# 書き込み待ちの取引1件分
+class PendingTransaction:
+    __slots__ = ("user_id", "prd_id", "stock_id", "date", "amount", "my_coupon_id", "coupon_id", "future")
+
+    def __init__(self, user_id, prd_id, stock_id, date, amount, my_coupon_id, coupon_id, future):
+        self.user_id = user_id
+        self.prd_id = prd_id
+        self.stock_id = stock_id
+        self.date = date
+        self.amount = amount
+        self.my_coupon_id = my_coupon_id
+        self.coupon_id = coupon_id
+        self.future = future
+
+# 取引データをまとめてコミットする書き込みキュー
+# N件たまるかTミリ秒たつごとに、在庫の減算と複数行INSERTを1トランザクションで行う
+# 呼び出し側にはコミットが終わってから取引IDを返す（在庫切れならNone）
+class TransactionBatcher:
+    def __init__(self, batch_size: int, max_wait_ms: float, queue_size: int):
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue_size = queue_size
+        self.enqueued = 0
+        self.rejected = 0
+        self.out_of_stock = 0
+        self.flushes = 0
+        self.written = 0
+        self.retried_batches = 0
+        self.max_batch = 0
+        self._queue = None
+        self._task = None
+        self._closing = False
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._closing = False
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, user_id, prd_id, stock_id, date, amount, my_coupon_id=None, coupon_id=None):
+        if self._closing or not self.running:
+            raise HTTPException(status_code=503, detail="Transaction writer is not accepting requests", headers={"Retry-After": "1"})
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait(PendingTransaction(user_id, prd_id, stock_id, date, amount, my_coupon_id, coupon_id, future))
+        except asyncio.QueueFull:
+            # 書き込みが追いついていないので、待たせずに断る
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Transaction queue is full", headers={"Retry-After": "1"})
+        self.enqueued += 1
+        # クライアントが切断しても書き込みは続ける
+        return await asyncio.shield(future)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        self.flushes += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        try:
+            if not await self._write(batch, final=len(batch) == 1):
+                # 他の書き込みと在庫の取り合いになったので1件ずつやり直す
+                self.retried_batches += 1
+                for item in batch:
+                    await self._write([item], final=True)
+        except Exception as e:
+            logger.error(f"A transaction batch write failed: {e}", exc_info=True)
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+
+    # 在庫を割り当てて減らし、取引をまとめて登録する。在庫が途中で変わっていたらFalse
+    async def _write(self, batch, final: bool) -> bool:
+        async with AsyncSessionLocal() as db:
+            stock_ids = {item.stock_id for item in batch}
+            available = dict((await db.execute(
+                select(ProductStocks.ID, ProductStocks.PIECES)
+                .where(ProductStocks.ID.in_(stock_ids))
+                .with_for_update()
+            )).all())
+            accepted = []
+            rejected = []
+            for item in batch:
+                if (available.get(item.stock_id) or 0) >= 1:
+                    available[item.stock_id] -= 1
+                    accepted.append(item)
+                else:
+                    rejected.append(item)
+            trd_ids = []
+            if accepted:
+                quantities = Counter(item.stock_id for item in accepted)
+                if not await decrement_stocks(db, dict(quantities)):
+                    await db.rollback()
+                    if not final:
+                        return False
+                    rejected.extend(accepted)
+                    accepted = []
+                else:
+                    trd_ids = await bulk_insert_returning_ids(db, TransactionData, [
+                        {"USER_ID": item.user_id, "PRD_ID": item.prd_id, "MY_COUPON_ID": item.my_coupon_id, "AMOUNT": item.amount, "DATE": item.date}
+                        for item in accepted
+                    ])
+                    await mark_coupons_used(db, [item.my_coupon_id for item in accepted])
+                    products = {}
+                    for prd_id in {item.prd_id for item in accepted}:
+                        products[prd_id] = await reference_cache.get_product(db, prd_id)
+                    await record_sales(db, [
+                        (item.date, products[item.prd_id], item.coupon_id, item.amount)
+                        for item in accepted if products[item.prd_id] is not None
+                    ])
+                    await db.commit()
+                    for user_id in {item.user_id for item in accepted if item.my_coupon_id is not None}:
+                        invalidate_my_coupon_cache(user_id)
+        self.written += len(accepted)
+        self.out_of_stock += len(rejected)
+        for item, trd_id in zip(accepted, trd_ids):
+            if not item.future.done():
+                item.future.set_result(trd_id)
+        for item in rejected:
+            if not item.future.done():
+                item.future.set_result(None)
+        return True
+
+    # 受付を止め、キューに残っている取引を書き込んでから終了する
+    async def stop(self):
+        if not self.running:
+            return
+        self._closing = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def stats(self):
+        return {
+            "enabled": 1 if self.running else 0,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "queue_size": self.queue_size,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "out_of_stock": self.out_of_stock,
+            "flushes": self.flushes,
+            "written": self.written,
+            "retried_batches": self.retried_batches,
+            "max_batch": self.max_batch,
+        }
+
+transaction_batcher = TransactionBatcher(TRANSACTION_BATCH_SIZE, TRANSACTION_BATCH_WAIT_MS, TRANSACTION_QUEUE_SIZE)
+# PRD_CODEの商品と指定日の在庫IDをDBから引く（バーコード索引にない・古い場合）
+async def find_stock_by_code(db: AsyncSession, prd_code: str, target_date):
+    date_data = await reference_cache.get_date(db, target_date)
+    prd_data = await reference_cache.get_product_by_code(db, prd_code)
+    if date_data is None or prd_data is None:
+        raise HTTPException(status_code=404, detail=f"Product {prd_code} not found")
+    # stocksTable内のdate、productが一致するレコードを取得
+    stock_id = (await db.execute(build_product_stock_query(date_data.ID, prd_data.ID))).scalar()
+    return prd_data, stock_id
+
+# 取引で使うマイクーポンのクーポンIDを引く（本人のマイクーポンでなければ404）
+# 未使用か、予約で使用済みにしたもので、期限内のものだけ使える
+async def find_coupon_id(db: AsyncSession, my_coupon_id: Optional[int], user_id, sale_date):
+    if my_coupon_id is None:
+        return None
+    if not str(user_id).isdigit():
+        raise HTTPException(status_code=400, detail="USER_ID must be a number to use a coupon")
+    my_coupon = (await db.execute(
+        select(MyCoupon.COUPON_ID, MyCoupon.STATUS, MyCoupon.EXP_DATE)
+        .where(MyCoupon.ID == my_coupon_id, MyCoupon.USER_ID == int(user_id))
+    )).first()
+    if my_coupon is None:
+        raise HTTPException(status_code=404, detail=f"MyCoupon {my_coupon_id} not found")
+    if my_coupon.STATUS not in (1, 2) or (my_coupon.EXP_DATE is not None and my_coupon.EXP_DATE < sale_date):
+        raise HTTPException(status_code=409, detail=f"MyCoupon {my_coupon_id} is expired or no longer usable")
+    return my_coupon.COUPON_ID
+
+# 取引で使ったマイクーポンを使用済みにする（取引と同じトランザクション。コミットは呼び出し側で行う）
+# 取引データから参照されるので、期限切れ処理・保管テーブルへの移動の対象から外れる
+async def mark_coupons_used(db: AsyncSession, my_coupon_ids):
+    my_coupon_ids = {my_coupon_id for my_coupon_id in my_coupon_ids if my_coupon_id is not None}
+    if not my_coupon_ids:
+        return
+    await db.execute(
+        update(MyCoupon)
+        .where(MyCoupon.ID.in_(my_coupon_ids))
+        .values(STATUS=2)
+        .execution_options(synchronize_session=False)
+    )
+
+# 1個売る（取引の登録と在庫の減算）。売り切れならNoneを返す
+# 取引には販売時の商品価格を金額として記録し、売上集計にも同じ金額を加算する
+async def sell_one(db: AsyncSession, user_id: str, prd_data, stock_id: int, sale_date, my_coupon_id=None, coupon_id=None):
+    # 書き込みキューが有効なら、他のレジの取引とまとめてコミットする
+    if transaction_batcher.running:
+        return await transaction_batcher.submit(user_id, prd_data.ID, stock_id, sale_date, prd_data.PRICE, my_coupon_id, coupon_id)
+    # 取引の登録と在庫の減算を1つのトランザクションで行う
+    trd = TransactionData(
+        USER_ID = user_id, 
+        PRD_ID = prd_data.ID, 
+        MY_COUPON_ID = my_coupon_id,
+        AMOUNT = prd_data.PRICE,
+        DATE = sale_date,
+    )
+    db.add(trd)
+    # 数量を1減らす（他のレジと同時に売れても在庫がずれないようにSQL側で減算）
+    if not await decrement_stocks(db, {stock_id: 1}):
+        await db.rollback()
+        return None
+    await mark_coupons_used(db, [my_coupon_id])
+    await record_sales(db, [(sale_date, prd_data, coupon_id, prd_data.PRICE)])
+    await db.commit()
+    if my_coupon_id is not None:
+        # ステータスが変わったのでマイクーポン一覧のキャッシュを破棄
+        invalidate_my_coupon_cache(user_id)
+    # 自動採番されたIDを返す
+    return trd.ID
+
 # 商品受け取り時の処理（バーコードで読み取る場合）
 @app.post("/TransactionData/")
 async def transactionData(
     user_id: str,
     prd_code: str,
-    db: Session = Depends(get_db_connection)):
+    my_coupon_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db)):
     try:
-        # with文を使って、データベースへの接続を自動的に閉じるようにする
-        with db:
-            # 現在の日付を取得
-            today = datetime.now()
-            # 日付を指定された形式の文字列に変換
-            formatted_date = today.date()
-            # 今日の日付のidを取得
-            date_id = db.query(Date).filter_by(DATE = formatted_date).first().ID
-            # prd_codeからprd_id取得
-            prd_data = db.query(Product).filter(Product.PRD_CODE == prd_code).first()
-            # stocksTable内のdate、productが一致するレコードを取得
-            ##### "1"の部分を本来はdate_idにすること（動かすために便宜的に1を代入） 
-            stocks_data = db.query(ProductStocks).filter(ProductStocks.DATE_ID == date_id).filter(ProductStocks.PRD_ID == prd_data.ID).first()
-            #reservationsTableから該当するレコードを取得 -> user_id、stock_idの2点一致で照合
-            reservation_data = db.query(Reservation).filter(Reservation.USER_ID == user_id).filter(Reservation.STOCK_ID == stocks_data.ID).first()
-            Product_id = prd_data.ID
-            # Transactionクラスのインスタンスを作成する
-            trd = TransactionData(
-                USER_ID = user_id, 
-                PRD_ID = Product_id, 
-                DATE = formatted_date,
-            )
-            # データベースにインスタンスを追加
-            db.add(trd)
-            db.commit()
-            # 自動採番されたIDを取得
-            trd_id = trd.ID
-            # 数量を1減らす
-            stocks_data.PIECES -= 1
-            db.commit()
-            # reservationsTableの該当するレコードを削除
-            #db.delete(reservation_data)
-            #db.commit()
-            # IDをレスポンスに含める
-            return {"TRD_ID": trd_id, "PRD": prd_data, "message": "Stock pieces decreased successfully. and Transaction data recorded." }
+        # 現在の日付を取得
+        today = datetime.now()
+        # 日付を指定された形式の文字列に変換
+        formatted_date = today.date()
+        # マイクーポンを使う場合は、使えるか確かめて売上集計用のクーポンIDを引いておく
+        coupon_id = await find_coupon_id(db, my_coupon_id, user_id, formatted_date)
+        # バーコード索引からprd_idと今日の在庫IDを取得（DBには問い合わせない）
+        hit = await barcode_index.lookup(prd_code)
+        prd_data = None
+        if hit is not None:
+            product_id, stock_id = hit
+            prd_data = await reference_cache.get_product(db, product_id)
+        from_index = prd_data is not None and prd_data.PRD_CODE == prd_code
+        if not from_index:
+            # 索引にない場合（他のワーカーで追加された商品など）や索引の商品が古い場合はDBから取得
+            prd_data, stock_id = await find_stock_by_code(db, prd_code, formatted_date)
+            if stock_id is None:
+                raise HTTPException(status_code=404, detail=f"Stock for {prd_code} not found")
+        trd_id = await sell_one(db, user_id, prd_data, stock_id, formatted_date, my_coupon_id, coupon_id)
+        if trd_id is None and from_index:
+            # 索引の在庫IDが古いと売り切れに見えるので、DBで引き直して別の在庫なら1回だけやり直す
+            prd_data, fresh_stock_id = await find_stock_by_code(db, prd_code, formatted_date)
+            if fresh_stock_id != stock_id:
+                barcode_index.correct(prd_data.ID, stock_id, fresh_stock_id)
+                if fresh_stock_id is None:
+                    raise HTTPException(status_code=404, detail=f"Stock for {prd_code} not found")
+                trd_id = await sell_one(db, user_id, prd_data, fresh_stock_id, formatted_date, my_coupon_id, coupon_id)
+        if trd_id is None:
+            raise HTTPException(status_code=409, detail=f"{prd_code} is out of stock")
+        # IDをレスポンスに含める
+        return {"TRD_ID": trd_id, "PRD": prd_data, "message": "Stock pieces decreased successfully. and Transaction data recorded." }
+    except HTTPException:
+        raise
     # 例外が発生した場合
     except Exception as e:
         # ログにエラーを出力
@@ -636,7 +3301,286 @@ async def transactionData(
         # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
         raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
 
-        
+
+# 購入履歴（取引データに商品情報を付ける）
+@app.get("/TransactionData/history")
+async def transaction_history(
+    user_id: int,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(HISTORY_DEFAULT_LIMIT, ge=1, le=HISTORY_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)):
+    conditions = [TransactionData.USER_ID == user_id]
+    if start is not None:
+        conditions.append(TransactionData.DATE >= start)
+    if end is not None:
+        conditions.append(TransactionData.DATE <= end)
+    if cursor:
+        cursor_date, cursor_id = decode_cursor(cursor, date.fromisoformat)
+        conditions.append(after_cursor(TransactionData.DATE, TransactionData.ID, cursor_date, cursor_id))
+    try:
+        query = (
+            select(
+                TransactionData.ID,
+                TransactionData.DATE,
+                TransactionData.PRD_ID,
+                TransactionData.MY_COUPON_ID,
+                TransactionData.AMOUNT,
+                Product.PRD_CODE,
+                Product.PRD_NAME,
+                Product.PRICE,
+            )
+            .outerjoin(Product, Product.ID == TransactionData.PRD_ID)
+            .where(*conditions)
+            .order_by(TransactionData.DATE.desc(), TransactionData.ID.desc())
+        )
+        return await history_page(db, query, limit)
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A transaction history error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+
+
+# かご単位の商品受け取り処理（複数の商品をまとめて会計する）
+@app.post("/TransactionData/batch/")
+async def checkoutBasket(
+    basket: CheckoutBasket = Body(...),
+    db: AsyncSession = Depends(get_async_db)):
+    try:
+        if not basket.PRD_CODES:
+            raise HTTPException(status_code=400, detail="PRD_CODES is empty")
+        formatted_date = datetime.now().date()
+        coupon_id = await find_coupon_id(db, basket.MY_COUPON_ID, basket.USER_ID, formatted_date)
+        # かごの商品コードに対応する商品と今日の在庫を1回で取得
+        rows = (await db.execute(build_basket_stock_query(basket.PRD_CODES, formatted_date))).all()
+        stock_by_code = {}
+        for product, stock_id in rows:
+            # 同じ商品の在庫が複数ある場合は最初のものを使う
+            stock_by_code.setdefault(product.PRD_CODE, (product, stock_id))
+        missing = sorted({code for code in basket.PRD_CODES if code not in stock_by_code})
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Stock for {', '.join(missing)} not found")
+
+        # マイクーポンはかご1回につき1回の利用なので、最初の商品の取引にだけ付ける
+        coupons = [(basket.MY_COUPON_ID, coupon_id)] + [(None, None)] * (len(basket.PRD_CODES) - 1)
+        # 取引データをまとめて登録し、在庫を商品ごとの数量でまとめて減らす（1トランザクション）
+        await db.execute(insert(TransactionData), [
+            {
+                "USER_ID": basket.USER_ID,
+                "PRD_ID": stock_by_code[code][0].ID,
+                "MY_COUPON_ID": my_coupon_id,
+                "AMOUNT": stock_by_code[code][0].PRICE,
+                "DATE": formatted_date,
+            }
+            for code, (my_coupon_id, _) in zip(basket.PRD_CODES, coupons)
+        ])
+        quantities = Counter(stock_by_code[code][1] for code in basket.PRD_CODES)
+        if not await decrement_stocks(db, dict(quantities)):
+            await db.rollback()
+            raise HTTPException(status_code=409, detail="Some items in the basket are out of stock")
+        await mark_coupons_used(db, [basket.MY_COUPON_ID])
+        await record_sales(db, [
+            (formatted_date, stock_by_code[code][0], line_coupon_id, stock_by_code[code][0].PRICE)
+            for code, (_, line_coupon_id) in zip(basket.PRD_CODES, coupons)
+        ])
+        await db.commit()
+        if basket.MY_COUPON_ID is not None:
+            # ステータスが変わったのでマイクーポン一覧のキャッシュを破棄
+            invalidate_my_coupon_cache(basket.USER_ID)
+        return {
+            "TRD_COUNT": len(basket.PRD_CODES),
+            "PRD": [stock_by_code[code][0] for code in basket.PRD_CODES],
+            "message": "Stock pieces decreased successfully. and Transaction data recorded.",
+        }
+    except HTTPException:
+        raise
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A checkoutBasket error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+
+
+# 売上分析（sales_rollupsの集計行から返し、取引データは読まない）
+# 期間の指定がなければ直近30日。1回に指定できる期間はANALYTICS_MAX_DAYS日まで
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = int(os.getenv('ANALYTICS_MAX_DAYS', '366'))
+
+def sales_period(start: Optional[date], end: Optional[date]):
+    end = end or datetime.now().date()
+    start = start or end - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must be on or before end")
+    if (end - start).days >= ANALYTICS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"The period must be {ANALYTICS_MAX_DAYS} days or shorter")
+    return start, end
+
+# 期間内の集計行を指定の列でまとめるクエリ（販売数・売上の合計を付ける）
+# MySQLのSUMはDECIMALで返りJSONにできないので、整数にCASTする
+def sales_query(start, end, *columns):
+    return (
+        select(
+            *columns,
+            cast(func.sum(SalesRollup.UNITS), Integer).label("UNITS"),
+            cast(func.sum(SalesRollup.REVENUE), Integer).label("REVENUE"),
+        )
+        .where(SalesRollup.DATE.between(start, end))
+        .group_by(*columns)
+    )
+
+async def sales_report(db: AsyncSession, name: str, start, end, query):
+    try:
+        result = await db.execute(query)
+        keys = tuple(result.keys())
+        data = [dict(zip(keys, row)) for row in result]
+        return FastJSONResponse({"status": "success", "start": start, "end": end, "data": data})
+    # 例外が発生した場合
+    except Exception as e:
+        # ログにエラーを出力
+        logger.error(f"A {name} sales report error occurred: {e}", exc_info=True)
+        # tracebackモジュールをインポート
+        import traceback
+        # エラーのスタックトレースを文字列に変換
+        error_trace = traceback.format_exc()
+        # HTTPExceptionを発生させて、ステータスコードを500にし、詳細をエラーとスタックトレースにする
+        raise HTTPException(status_code=500, detail=f"Error processing data: {e}\n{error_trace}")
+
+# 日別の販売数・売上
+@app.get("/Analytics/sales/daily")
+async def sales_by_day(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: AsyncSession = Depends(get_async_db)):
+    start, end = sales_period(start, end)
+    query = sales_query(start, end, SalesRollup.DATE).order_by(SalesRollup.DATE)
+    return await sales_report(db, "daily", start, end, query)
+
+# 商品別の販売数・売上（売上の多い順）
+@app.get("/Analytics/sales/products")
+async def sales_by_product(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(50, ge=1, le=1000),
+    db: AsyncSession = Depends(get_async_db)):
+    start, end = sales_period(start, end)
+    query = (
+        sales_query(start, end, SalesRollup.PRD_ID, Product.PRD_CODE, Product.PRD_NAME, SalesRollup.CATEGORY_ID)
+        .outerjoin(Product, Product.ID == SalesRollup.PRD_ID)
+        .order_by(func.sum(SalesRollup.REVENUE).desc(), SalesRollup.PRD_ID)
+        .limit(limit)
+    )
+    return await sales_report(db, "product", start, end, query)
+
+# カテゴリー別の販売数・売上
+@app.get("/Analytics/sales/categories")
+async def sales_by_category(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: AsyncSession = Depends(get_async_db)):
+    start, end = sales_period(start, end)
+    query = (
+        sales_query(start, end, SalesRollup.CATEGORY_ID, Category.NAME)
+        .outerjoin(Category, Category.ID == SalesRollup.CATEGORY_ID)
+        .order_by(SalesRollup.CATEGORY_ID)
+    )
+    return await sales_report(db, "category", start, end, query)
+
+# クーポン別の利用数（クーポンを使った販売の販売数・売上）
+@app.get("/Analytics/sales/coupons")
+async def sales_by_coupon(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: AsyncSession = Depends(get_async_db)):
+    start, end = sales_period(start, end)
+    query = (
+        sales_query(start, end, SalesRollup.COUPON_ID, Coupon.NAME)
+        .outerjoin(Coupon, Coupon.ID == SalesRollup.COUPON_ID)
+        .where(SalesRollup.COUPON_ID != 0)
+        .order_by(SalesRollup.COUPON_ID)
+    )
+    return await sales_report(db, "coupon", start, end, query)
+
+
+# 計測値・接続プール・キャッシュの状態をPrometheus形式で出力する
+def _render_gauges(name: str, help_text: str, samples):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{{{_format_labels(labels.keys(), labels.values())}}} {value}")
+    return lines
+
+# stats()の数値項目をゲージにする（日付などの文字列は出さない）
+def _stats_samples(label_name: str, stats_by_name: dict):
+    samples = {}
+    for label, stats in stats_by_name.items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                samples.setdefault(key, []).append(({label_name: label}, value))
+    return samples
+
+def render_metrics():
+    lines = []
+    for metric in (request_latency, request_db_time, request_statements, requests_total,
+                   pool_checkout_wait, pool_checkout_timeouts, slow_queries_total):
+        lines.extend(metric.render())
+
+    # 接続プールの使用状況（使用中 / (プールサイズ + 最大オーバーフロー) を飽和度とする）
+    pool_samples = {"size": [], "checked_out": [], "overflow": [], "saturation": []}
+    for label, pool in (("sync", engine.pool), ("async", async_engine.pool)):
+        if not isinstance(pool, QueuePool):
+            continue
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        pool_samples["size"].append(({"pool": label}, pool.size()))
+        pool_samples["checked_out"].append(({"pool": label}, pool.checkedout()))
+        pool_samples["overflow"].append(({"pool": label}, max(pool.overflow(), 0)))
+        pool_samples["saturation"].append(({"pool": label}, round(pool.checkedout() / capacity, 4) if capacity else 0))
+    for key, samples in pool_samples.items():
+        lines.extend(_render_gauges(f"pos_db_pool_{key}", f"Connection pool {key.replace('_', ' ')}.", samples))
+
+    cache_stats = {
+        "reference": reference_cache.stats(),
+        "my_coupon": my_coupon_cache.stats(),
+        "user_claims": user_claims_cache.stats(),
+        "product_response": product_responses.stats(),
+        "stock_snapshot": stock_snapshots.stats(),
+    }
+    for key, samples in _stats_samples("cache", cache_stats).items():
+        lines.extend(_render_gauges(f"pos_cache_{key}", f"In-process cache {key}.", samples))
+    flight_stats = {"stocks": stock_flights.stats(), "products": product_flights.stats()}
+    for key, samples in _stats_samples("flight", flight_stats).items():
+        lines.extend(_render_gauges(f"pos_single_flight_{key}", f"Single-flight reads {key.replace('_', ' ')}.", samples))
+    for key, samples in _stats_samples("queue", {"transaction": transaction_batcher.stats()}).items():
+        lines.extend(_render_gauges(f"pos_write_behind_{key}", f"Transaction write-behind queue {key.replace('_', ' ')}.", samples))
+    for key, samples in _stats_samples("sequence", {"employee_id": employee_id_allocator.stats()}).items():
+        lines.extend(_render_gauges(f"pos_id_allocator_{key}", f"Block ID allocator {key.replace('_', ' ')}.", samples))
+    for key, samples in _stats_samples("job", {"coupon_expiry": coupon_sweeper.stats()}).items():
+        lines.extend(_render_gauges(f"pos_coupon_sweep_{key}", f"Coupon expiry sweeper {key.replace('_', ' ')}.", samples))
+    for key, samples in _stats_samples("hub", {"stock": stock_hub.stats()}).items():
+        lines.extend(_render_gauges(f"pos_stock_stream_{key}", f"Live stock stream {key}.", samples))
+    for key, samples in _stats_samples("index", {"barcode": barcode_index.stats()}).items():
+        lines.extend(_render_gauges(f"pos_barcode_index_{key}", f"Barcode index {key.replace('_', ' ')}.", samples))
+    for key, samples in _stats_samples("pool", {"bcrypt": password_hasher.stats()}).items():
+        lines.extend(_render_gauges(f"pos_password_hasher_{key}", f"Password hasher {key.replace('_', ' ')}.", samples))
+    admission_stats = {"all": admission_controller.stats(), **admission_controller.class_stats()}
+    for key, samples in _stats_samples("class", admission_stats).items():
+        lines.extend(_render_gauges(f"pos_admission_{key}", f"Admission control {key.replace('_', ' ')}.", samples))
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 # # /transactionStatementData/というエンドポイントにPOSTリクエストを送ると、取引明細データのリストを受け取って、データベースに保存
 # @app.post("/transactionStatementData/")
@@ -0,0 +1,289 @@
+# スキーマ・インデックスのマイグレーション
+#   python -m migrations upgrade   未適用のマイグレーションを順番に適用する
+#   python -m migrations status    マイグレーションの適用状況を表示する
+#   python -m migrations check     よく使うクエリをEXPLAINし、全件スキャンがあれば終了コード1で終わる
+#   python -m migrations rebuild-sales [開始日] [終了日]   取引データから売上集計を作り直す（YYYY-MM-DD）
+# 接続先はmain.pyと同じ環境変数（DATABASE_URL / MYSQL_*）で決まる
+import sys
+from datetime import datetime, date
+
+from sqlalchemy import MetaData, Table, Column, String, DateTime, Index, inspect, select, insert, update, func, text
+
+from main import (
+    engine,
+    logger,
+    IdSequence,
+    MyCoupon,
+    MyCouponArchive,
+    Product,
+    Reservation,
+    SalesRollup,
+    TransactionData,
+    User,
+    build_basket_stock_query,
+    build_my_coupon_query,
+    build_product_stock_query,
+    build_stock_product_query,
+    rebuild_sales_rollups,
+)
+
+# 適用済みのマイグレーションを記録するテーブル
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("VERSION", String(64), primary_key=True),
+    Column("APPLIED_AT", DateTime),
+)
+
+
+# 既存のテーブル定義をDBから読み込む（存在しない参照先テーブルは読みにいかない）
+def _reflect(conn, table_name):
+    return Table(table_name, MetaData(), autoload_with=conn, resolve_fks=False)
+
+def _index_names(conn, table_name):
+    return {index["name"] for index in inspect(conn).get_indexes(table_name)}
+
+# インデックスを作成する（テーブルがない・作成済みの場合は何もしない）
+def create_index(conn, table_name, name, *columns, unique=False):
+    if not inspect(conn).has_table(table_name) or name in _index_names(conn, table_name):
+        return
+    table = _reflect(conn, table_name)
+    Index(name, *[table.c[column] for column in columns], unique=unique).create(conn)
+    logger.info(f"Created index {name} on {table_name}")
+
+# インデックスを削除する（テーブルがない・削除済みの場合は何もしない）
+def drop_index(conn, table_name, name):
+    if not inspect(conn).has_table(table_name) or name not in _index_names(conn, table_name):
+        return
+    table = _reflect(conn, table_name)
+    index = next(index for index in table.indexes if index.name == name)
+    index.drop(conn)
+    logger.info(f"Dropped index {name} on {table_name}")
+
+# カラムを追加する（テーブルがない・追加済みの場合は何もしない）
+def add_column(conn, column):
+    table_name = column.table.name
+    if not inspect(conn).has_table(table_name) or column.key in {item["name"] for item in inspect(conn).get_columns(table_name)}:
+        return
+    preparer = conn.dialect.identifier_preparer
+    conn.execute(text(
+        f"ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {preparer.quote(column.key)} {column.type.compile(conn.dialect)}"
+    ))
+    logger.info(f"Added column {column.key} to {table_name}")
+
+# 取引データに販売時の金額のカラムを追加し、金額のない取引には現在の商品価格を入れる
+# （追加前の販売時の価格は残っていないので、現在の価格が分かる中で一番近い値になる）
+def add_transaction_amounts(conn):
+    add_column(conn, TransactionData.__table__.c.AMOUNT)
+    result = conn.execute(
+        update(TransactionData)
+        .where(TransactionData.AMOUNT.is_(None))
+        .values(AMOUNT=select(Product.PRICE).where(Product.ID == TransactionData.PRD_ID).scalar_subquery())
+    )
+    logger.info(f"Filled AMOUNT of {result.rowcount} transaction records")
+
+
+# 検索に使われていない単一カラムのインデックス（INSERTのたびに更新コストだけかかる）
+# IDは主キーのインデックスで引けるので、別に作られたインデックスは不要
+UNUSED_INDEXES = {
+    "users": ("ID",),
+    "products": ("ID", "PRD_NAME", "PRD_IMAGE", "DESCRIPTION", "PRICE", "CAL", "SALINITY"),
+    "stocks": ("ID", "STORE_ID", "DATE_ID", "LOT", "BEST_BY_DAY", "PIECES"),
+    "reservations": ("ID", "RSV_TIME", "STOCK_ID", "USER_ID", "MET", "DATE"),
+    "coupons": ("ID", "NAME", "IMAGE", "DESCRIPTION", "EXPIRATION", "PRICE"),
+    "my_coupons": ("ID", "USER_ID", "COUPON_ID", "GET_DATE", "EXP_DATE", "STATUS"),
+    "transaction_records": ("ID", "USER_ID", "PRD_ID", "MY_COUPON_ID"),
+    "dates": ("ID", "WEEK"),
+    "categories": ("ID",),
+}
+
+def drop_unused_indexes(conn):
+    for table_name, columns in UNUSED_INDEXES.items():
+        for column in columns:
+            drop_index(conn, table_name, f"ix_{table_name}_{column}")
+
+# 0001: 実際のクエリに合わせた複合インデックスを作り、使われていないインデックスを削除する
+# （外部キーが使うインデックスを消さないよう、複合インデックスを先に作る）
+def _0001_query_indexes(conn):
+    create_index(conn, "stocks", "ix_stocks_DATE_ID_PRD_ID", "DATE_ID", "PRD_ID")
+    create_index(conn, "reservations", "ix_reservations_USER_ID_STOCK_ID", "USER_ID", "STOCK_ID")
+    create_index(conn, "my_coupons", "ix_my_coupons_USER_ID_STATUS_EXP_DATE", "USER_ID", "STATUS", "EXP_DATE")
+    drop_unused_indexes(conn)
+
+# 0002: 売上集計テーブルを作り、既存の取引データから集計する
+def _0002_sales_rollups(conn):
+    SalesRollup.__table__.create(conn, checkfirst=True)
+    # 集計は取引データの金額から作るので、0007より前でもカラムを先に追加しておく
+    add_transaction_amounts(conn)
+    logger.info(f"Rebuilt sales rollups: {rebuild_sales_rollups(conn)}")
+
+# 0003: マイクーポンの期限切れ処理用のインデックスと保管テーブルを作る
+def _0003_coupon_expiry(conn):
+    create_index(conn, "my_coupons", "ix_my_coupons_STATUS_EXP_DATE", "STATUS", "EXP_DATE")
+    MyCouponArchive.__table__.create(conn, checkfirst=True)
+
+# カラムに重複した値があればその値の一覧を返す（ユニークインデックスを作る前の確認）
+def _duplicates(conn, column):
+    return conn.execute(
+        select(column).where(column.is_not(None)).group_by(column).having(func.count() > 1).limit(20)
+    ).scalars().all()
+
+def _has_unique_index(conn, table_name, column):
+    inspector = inspect(conn)
+    indexes = [index for index in inspector.get_indexes(table_name) if index["unique"]]
+    constraints = inspector.get_unique_constraints(table_name)
+    return any(item["column_names"] == [column] for item in (*indexes, *constraints))
+
+# 0004: 社員番号の採番テーブルを作り、社員番号とメールアドレスをユニークにする
+def _0004_id_sequences(conn):
+    for column, name in ((User.employee_Id, "ux_users_employee_Id"), (User.EMAIL, "ux_users_EMAIL")):
+        if _has_unique_index(conn, "users", column.key):
+            continue
+        duplicates = _duplicates(conn, column)
+        if duplicates:
+            raise RuntimeError(f"users.{column.key} has duplicate values, fix them before migrating: {duplicates}")
+        create_index(conn, "users", name, column.key, unique=True)
+    drop_index(conn, "users", "ix_users_employee_Id")
+    IdSequence.__table__.create(conn, checkfirst=True)
+    if conn.execute(select(IdSequence.NAME).where(IdSequence.NAME == "users.employee_Id")).first() is None:
+        next_value = (conn.execute(select(func.max(User.employee_Id))).scalar() or 0) + 1
+        conn.execute(insert(IdSequence).values(NAME="users.employee_Id", NEXT_VALUE=next_value))
+
+# 0005: 予約履歴・購入履歴のページング用の複合インデックスを作る
+def _0005_history_indexes(conn):
+    create_index(conn, "reservations", "ix_reservations_USER_ID_DATE_ID", "USER_ID", "DATE", "ID")
+    create_index(conn, "transaction_records", "ix_transaction_records_USER_ID_DATE_ID", "USER_ID", "DATE", "ID")
+
+# 0006: 0001の適用後にUNUSED_INDEXESへ追加した、主キーと重複するIDのインデックスを削除する
+def _0006_drop_primary_key_indexes(conn):
+    drop_unused_indexes(conn)
+
+# 0007: 取引データに販売時の金額を記録する（売上集計の作り直しで過去の売上が変わらないように）
+def _0007_transaction_amounts(conn):
+    add_transaction_amounts(conn)
+
+
+# マイグレーションの一覧（バージョン名の順に適用する）
+MIGRATIONS = [
+    ("0001_query_indexes", _0001_query_indexes),
+    ("0002_sales_rollups", _0002_sales_rollups),
+    ("0003_coupon_expiry", _0003_coupon_expiry),
+    ("0004_id_sequences", _0004_id_sequences),
+    ("0005_history_indexes", _0005_history_indexes),
+    ("0006_drop_primary_key_indexes", _0006_drop_primary_key_indexes),
+    ("0007_transaction_amounts", _0007_transaction_amounts),
+]
+
+
+def applied_versions(conn):
+    migration_metadata.create_all(conn)
+    return {row.VERSION for row in conn.execute(select(schema_migrations.c.VERSION))}
+
+# 未適用のマイグレーションを1つずつ適用する
+def upgrade(bind=engine):
+    with bind.begin() as conn:
+        done = applied_versions(conn)
+    applied = []
+    for version, migrate in MIGRATIONS:
+        if version in done:
+            continue
+        with bind.begin() as conn:
+            migrate(conn)
+            conn.execute(insert(schema_migrations).values(VERSION=version, APPLIED_AT=datetime.now()))
+        logger.info(f"Applied migration {version}")
+        applied.append(version)
+    return applied
+
+def status(bind=engine):
+    with bind.begin() as conn:
+        done = applied_versions(conn)
+    return [(version, version in done) for version, _ in MIGRATIONS]
+
+
+# 全件スキャンになってはいけないクエリ（名前, 確認するテーブル, クエリ）
+def hot_queries():
+    today = date.today()
+    return [
+        ("stock_by_date_and_product", "stocks",
+            build_product_stock_query(1, 1)),
+        ("basket_stocks", "stocks",
+            build_basket_stock_query(["4900000000001"], today)),
+        ("stock_list", "stocks",
+            build_stock_product_query(today, "category")),
+        ("reservation_list", "reservations",
+            select(Reservation.ID).where(Reservation.USER_ID == "1", Reservation.STOCK_ID != 9999)),
+        ("my_coupon_wallet", "my_coupons",
+            build_my_coupon_query(1, today)),
+        ("coupon_expiry_sweep", "my_coupons",
+            select(MyCoupon.ID).where(MyCoupon.STATUS == 1, MyCoupon.EXP_DATE < today).limit(1000)),
+        ("transactions_by_date", "transaction_records",
+            select(TransactionData.ID).where(TransactionData.DATE == today)),
+        ("reservation_history", "reservations",
+            select(Reservation.ID).where(Reservation.USER_ID == "1")
+            .order_by(Reservation.DATE.desc(), Reservation.ID.desc()).limit(21)),
+        ("transaction_history", "transaction_records",
+            select(TransactionData.ID).where(TransactionData.USER_ID == 1)
+            .order_by(TransactionData.DATE.desc(), TransactionData.ID.desc()).limit(21)),
+    ]
+
+# クエリの実行計画を取得する（INの値は展開してから渡す）
+def explain(conn, statement):
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    return [dict(row._mapping) for row in conn.exec_driver_sql(prefix + str(compiled), params)]
+
+# 実行計画の中で指定テーブルを全件（またはインデックス全体）スキャンしていないか
+# SQLiteの「AUTOMATIC INDEX」は実行のたびに全件を読んで一時インデックスを作るので全件スキャン扱い
+def is_full_scan(dialect_name, plan, table_name):
+    if dialect_name == "sqlite":
+        for row in plan:
+            words = row["detail"].split()
+            if words[1:2] == [table_name] and (words[0] == "SCAN" or "AUTOMATIC" in words):
+                return True
+        return False
+    return any(row.get("table") == table_name and row.get("type") in ("ALL", "index") for row in plan)
+
+# よく使うクエリをEXPLAINし、全件スキャンになっているクエリ名の一覧を返す
+def check(bind=engine):
+    failures = []
+    with bind.connect() as conn:
+        for name, table_name, statement in hot_queries():
+            plan = explain(conn, statement)
+            if is_full_scan(conn.dialect.name, plan, table_name):
+                failures.append((name, plan))
+    return failures
+
+
+def run(argv):
+    command = argv[1] if len(argv) > 1 else "upgrade"
+    if command == "upgrade":
+        applied = upgrade()
+        print(f"Applied {len(applied)} migration(s): {', '.join(applied) or '-'}")
+        return 0
+    if command == "status":
+        for version, done in status():
+            print(f"{'x' if done else ' '} {version}")
+        return 0
+    if command == "check":
+        failures = check()
+        for name, plan in failures:
+            print(f"FULL SCAN: {name}")
+            for row in plan:
+                print(f"    {row}")
+        print("OK" if not failures else f"{len(failures)} hot query(s) fall back to a full scan")
+        return 1 if failures else 0
+    if command == "rebuild-sales":
+        start = date.fromisoformat(argv[2]) if len(argv) > 2 else None
+        end = date.fromisoformat(argv[3]) if len(argv) > 3 else None
+        print(f"Rebuilt sales rollups: {rebuild_sales_rollups(engine, start, end)}")
+        return 0
+    print(f"Unknown command: {command} (upgrade / status / check / rebuild-sales)")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv))
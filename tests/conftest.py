@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# mainをimportする前に、接続先をテスト用の一時的なSQLiteファイルに向ける
+_db_dir = tempfile.mkdtemp(prefix="pos-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.setdefault("SECRET_KEY", "test-secret")
+# テストデータのパスワードハッシュを速く作るため
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
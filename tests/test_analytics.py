@@ -0,0 +1,41 @@
+from datetime import date, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.dialects import mysql
+
+import main
+from benchmarks.seed import SeedSize, seed
+
+
+@pytest.fixture(scope="module")
+def client():
+    seed(main.engine, SeedSize(
+        stores=1, days=1, categories=3, products=20, users=5, coupons=3,
+        reservations_per_user=0, coupons_per_user=0, transactions=200,
+    ))
+    main.rebuild_sales_rollups(main.engine)
+    return TestClient(main.app)
+
+
+# 販売数・売上の合計はDBの数値型（MySQLではDECIMAL）ではなく整数で返す
+@pytest.mark.parametrize("path", ["daily", "products", "categories"])
+def test_sales_totals_are_ints(client, path):
+    params = {"start": (date.today() - timedelta(days=90)).isoformat(), "end": date.today().isoformat()}
+    response = client.get(f"/Analytics/sales/{path}", params=params)
+
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data
+    assert sum(row["UNITS"] for row in data) == 200
+    for row in data:
+        assert type(row["UNITS"]) is int
+        assert type(row["REVENUE"]) is int
+
+
+def test_sales_totals_are_cast_on_mysql():
+    query = main.sales_query(date.today(), date.today(), main.SalesRollup.DATE)
+    sql = str(query.compile(dialect=mysql.dialect()))
+
+    assert "CAST(sum(sales_rollups.`UNITS`) AS SIGNED INTEGER)" in sql
+    assert "CAST(sum(sales_rollups.`REVENUE`) AS SIGNED INTEGER)" in sql
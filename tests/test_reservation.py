@@ -0,0 +1,42 @@
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, func, select
+
+import main
+from benchmarks.seed import SeedSize, seed
+
+
+# 予約一覧の取得1回で実行されたSQLを数える
+def count_statements(client, params):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(main.async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get("/Reservation/", params=params)
+    finally:
+        event.remove(main.async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    return response, statements
+
+
+# 予約の件数に関係なく、在庫の予約とクーポンの予約のクエリ2回で一覧を作る
+@pytest.mark.parametrize("reservations", [1, 10, 60])
+def test_reservation_list_uses_bounded_statements(reservations):
+    seed(main.engine, SeedSize(
+        stores=1, days=1, categories=1, products=20, users=1, coupons=3,
+        reservations_per_user=reservations, coupons_per_user=3, transactions=0,
+    ))
+    with main.engine.connect() as conn:
+        expected = conn.execute(
+            select(func.count()).select_from(main.Reservation).where(main.Reservation.USER_ID == "1")
+        ).scalar()
+
+    response, statements = count_statements(TestClient(main.app), {"user_id": "1", "date": date.today().isoformat()})
+
+    assert response.status_code == 200
+    assert len(response.json()["data"]) == expected
+    assert len(statements) <= 2, statements
@@ -0,0 +1,71 @@
+from datetime import date, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select, update
+
+import main
+from benchmarks.seed import SeedSize, seed
+
+
+@pytest.fixture()
+def shop():
+    info = seed(main.engine, SeedSize(
+        stores=1, days=1, categories=1, products=5, users=2, coupons=2,
+        reservations_per_user=0, coupons_per_user=2, transactions=0,
+    ))
+    with main.engine.begin() as conn:
+        conn.execute(update(main.MyCoupon).values(STATUS=1, EXP_DATE=date.today() + timedelta(days=7)))
+        my_coupon_id = conn.execute(select(main.MyCoupon.ID).where(main.MyCoupon.USER_ID == 1)).scalars().first()
+    main.my_coupon_cache.clear()
+    return TestClient(main.app), info["product_codes"], my_coupon_id
+
+
+def coupon_status(my_coupon_id):
+    with main.engine.connect() as conn:
+        return conn.execute(select(main.MyCoupon.STATUS).where(main.MyCoupon.ID == my_coupon_id)).scalar()
+
+
+def coupon_units():
+    with main.engine.connect() as conn:
+        return conn.execute(
+            select(func.sum(main.SalesRollup.UNITS)).where(main.SalesRollup.COUPON_ID != 0)
+        ).scalar()
+
+
+# レジでマイクーポンを使うと、取引と同じトランザクションで使用済みになる
+def test_coupon_is_marked_used_with_the_sale(shop):
+    client, codes, my_coupon_id = shop
+    response = client.post("/TransactionData/", params={"user_id": "1", "prd_code": codes[0], "my_coupon_id": my_coupon_id})
+
+    assert response.status_code == 200
+    assert coupon_status(my_coupon_id) == 2
+
+
+# 期限切れのマイクーポンは使えない
+def test_expired_coupon_is_rejected(shop):
+    client, codes, my_coupon_id = shop
+    with main.engine.begin() as conn:
+        conn.execute(update(main.MyCoupon).where(main.MyCoupon.ID == my_coupon_id).values(STATUS=main.MY_COUPON_EXPIRED))
+    response = client.post("/TransactionData/", params={"user_id": "1", "prd_code": codes[0], "my_coupon_id": my_coupon_id})
+
+    assert response.status_code == 409
+
+
+def test_non_numeric_user_id_is_rejected(shop):
+    client, codes, my_coupon_id = shop
+    response = client.post("/TransactionData/", params={"user_id": "abc", "prd_code": codes[0], "my_coupon_id": my_coupon_id})
+
+    assert response.status_code == 400
+
+
+# かごで使ったマイクーポンは、商品の数に関係なく1回の利用として集計する
+def test_basket_counts_coupon_once(shop):
+    client, codes, my_coupon_id = shop
+    response = client.post("/TransactionData/batch/", json={"USER_ID": "1", "PRD_CODES": codes[:3], "MY_COUPON_ID": my_coupon_id})
+
+    assert response.status_code == 200
+    assert coupon_status(my_coupon_id) == 2
+    assert coupon_units() == 1
+    main.rebuild_sales_rollups(main.engine)
+    assert coupon_units() == 1
@@ -0,0 +1,18 @@
+import uuid
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+# 登録したユーザーを返すときにパスワードのハッシュを含めない
+def test_create_user_does_not_return_password():
+    name = f"user-{uuid.uuid4().hex[:8]}"
+    main.User.__table__.create(main.engine, checkfirst=True)
+    main.IdSequence.__table__.create(main.engine, checkfirst=True)
+    response = TestClient(main.app).post("/users/", json={"username": name, "email": f"{name}@example.com", "password": "secret"})
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["USER_NAME"] == name
+    assert "PASSWORD" not in body